@@ -16,13 +16,28 @@ index = {"Config": "00_config.ipynb",
          "run_cellpose": "01_models.ipynb",
          "show": "02_data.ipynb",
          "preprocess_mask": "02_data.ipynb",
+         "calculate_weights": "02_data.ipynb",
          "DeformationField": "02_data.ipynb",
+         "LazyTiff": "02_data.ipynb",
+         "SharedArrayCache": "02_data.ipynb",
+         "SharedMemoryDataset": "02_data.ipynb",
          "tiles_in_rectangles": "02_data.ipynb",
+         "MaskCodec": "02_data.ipynb",
+         "ChannelStats": "02_data.ipynb",
+         "channel_stats": "02_data.ipynb",
          "BaseDataset": "02_data.ipynb",
          "RandomTileDataset": "02_data.ipynb",
          "TileDataset": "02_data.ipynb",
+         "WeightMapCallback": "03_learner.ipynb",
+         "DeviceNormalizeCallback": "03_learner.ipynb",
+         "DistributedCallback": "03_learner.ipynb",
+         "TileCurriculumCallback": "03_learner.ipynb",
+         "StepBudgetCallback": "03_learner.ipynb",
+         "ThroughputCallback": "03_learner.ipynb",
+         "CheckpointCallback": "03_learner.ipynb",
          "EnsembleBase": "03_learner.ipynb",
          "EnsembleLearner": "03_learner.ipynb",
+         "HyperparameterSearch": "03_learner.ipynb",
          "EnsemblePredictor": "03_learner.ipynb",
          "torch_gaussian": "04_inference.ipynb",
          "gaussian_kernel_2d": "04_inference.ipynb",
@@ -38,6 +53,7 @@ index = {"Config": "00_config.ipynb",
          "WeightedLoss": "05_losses.ipynb",
          "JointLoss": "05_losses.ipynb",
          "Poly1CrossEntropyLoss": "05_losses.ipynb",
+         "WeightedCrossEntropyLoss": "05_losses.ipynb",
          "get_loss": "05_losses.ipynb",
          "unzip": "06_utils.ipynb",
          "download_sample_data": "06_utils.ipynb",
@@ -47,6 +63,9 @@ index = {"Config": "00_config.ipynb",
          "clean_show": "06_utils.ipynb",
          "plot_results": "06_utils.ipynb",
          "Recorder.plot_metrics": "06_utils.ipynb",
+         "fast_confusion_matrix": "06_utils.ipynb",
+         "fast_confusion_matrices": "06_utils.ipynb",
+         "segmentation_scores": "06_utils.ipynb",
          "multiclass_dice_score": "06_utils.ipynb",
          "binary_dice_score": "06_utils.ipynb",
          "dice_score": "06_utils.ipynb",
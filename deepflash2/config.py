@@ -23,6 +23,9 @@ class Config:
 
     # Train General Settings
     n_models:int = 5
+    n_parallel:int = 1 # Models trained at once in separate processes (fit_ensemble)
+    distributed:bool = False # Data-parallel training of each model on all ranks launched with torchrun
+    dist_backend:str = 'gloo'
     max_splits:int=5
     random_state:int = 42
     use_gpu:bool = True
@@ -35,18 +38,31 @@ class Config:
     # Train Data Settings
     num_classes:int = 2
     tile_shape:int = 512
+    tile_curriculum_min:int = 0 # Training tiles grow from this size to tile_shape (0: no curriculum)
+    tile_curriculum_pct:float = 0.5 # Fraction of the epochs until the tiles reach tile_shape
     scale:float = 1.
+    use_pyramid:bool = False
     instance_labels:bool = False
+    preproc_compressor:str = 'lz4'
+    cache_size_gb:float = 0.
+    data_backend:str = 'zarr'
+    sampling:str = 'cdf' # 'cdf', 'grid', or 'balanced'
+    device_normalization:bool = False # Normalize raw (e.g., uint8) tiles on the training device
+    materialize_val_tiles:bool = False # Store validation tiles once per fold in the preprocessing directory
 
     # Train Settings
     base_lr:float = 0.001
     batch_size:int = 4
+    effective_batch_size:int = 0 # Samples per optimizer step with gradient accumulation (0: batch_size)
     weight_decay:float = 0.001
     mixed_precision_training:bool = True
+    activation_checkpointing:bool = False # Recompute encoder and decoder activations in the backward pass to save memory
     optim:str = 'Adam'
     loss:str = 'CrossEntropyDiceLoss'
     n_epochs:int = 25
+    n_iterations:int = 0 # Optimizer steps per model (with gradient accumulation and tile curriculum), sets the epochs and their length (0: n_epochs)
     sample_mult:int = 0
+    checkpoint_iters:int = 500 # Training iterations between resumable checkpoints (0: only at the start of each epoch)
 
     # Train Data Augmentation
     gamma_limit_lower:int = 80
@@ -64,6 +80,10 @@ class Config:
     loss_beta:float = 0.5 # Twerksy Loss
     loss_gamma:float = 2.0 # Focal loss
     loss_smooth_factor:float = 0. #SoftCrossEntropyLoss
+    border_weights:bool = False # WeightedCrossEntropyLoss
+    border_weight_sigma_px:float = 6.
+    border_weight_factor:float = 50.
+    foreground_background_ratio:float = 1.
 
     # Pred/Val Settings
     use_tta:bool = True
@@ -86,6 +106,7 @@ class Config:
     pred_dir:str = 'Prediction'
     ens_dir:str = 'models'
     val_dir:str = 'valid'
+    preproc_dir:str = '.preproc'
 
     def __post_init__(self):
         self.set_device()
@@ -102,10 +123,15 @@ class Config:
                   'brightness_limit', 'contrast_limit', 'distort_limit']
         return dict(filter(lambda x: x[0] in kwargs, self.__dict__.items()))
 
+    @property
+    def weight_kwargs(self):
+        kwargs = ['border_weight_sigma_px', 'border_weight_factor', 'foreground_background_ratio']
+        return dict(filter(lambda x: x[0] in kwargs, self.__dict__.items()))
+
     @property
     def inference_kwargs(self):
         inference_kwargs = ['use_tta', 'max_tile_shift', 'use_gaussian', 'scale',
-                            'gaussian_kernel_sigma_scale', 'border_padding_factor']
+                            'gaussian_kernel_sigma_scale', 'border_padding_factor', 'use_pyramid']
         return dict(filter(lambda x: x[0] in inference_kwargs, self.__dict__.items()))
 
     def save(self, path):
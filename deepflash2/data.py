@@ -1,12 +1,24 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/02_data.ipynb (unless otherwise specified).
 
-__all__ = ['show', 'preprocess_mask', 'DeformationField', 'tiles_in_rectangles', 'BaseDataset', 'RandomTileDataset',
-           'TileDataset']
+__all__ = ['show', 'preprocess_mask', 'calculate_weights', 'DeformationField', 'LazyTiff', 'SharedArrayCache',
+           'SharedMemoryDataset', 'tiles_in_rectangles', 'MaskCodec', 'ChannelStats', 'channel_stats', 'BaseDataset',
+           'RandomTileDataset', 'TileDataset']
 
 # Cell
-import os, zarr, cv2, imageio, shutil, random
+import os, zarr, cv2, imageio, tifffile, shutil, random, hashlib, secrets, warnings, weakref
+import multiprocessing as mp
+from collections.abc import MutableMapping
+try: from multiprocessing import shared_memory, resource_tracker
+except ImportError: shared_memory = None # python<3.8
+try: import numba
+except ImportError: numba = None
 
 import numpy as np
+from PIL import Image
+from numcodecs import Blosc, register_codec
+from numcodecs.abc import Codec
+from numcodecs.compat import ensure_ndarray, ensure_bytes, ndarray_copy
+from scipy import ndimage
 
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
@@ -109,6 +121,97 @@ def show(*obj, file_name=None, overlay=False, pred=False, num_classes=2,
     plt.tight_layout()
     plt.show()
 
+# Cell
+def _njit(f):
+    "Compiles `f` with numba (or returns `None` if numba is not installed)"
+    if numba is None: return None
+    try: return numba.njit(nogil=True, cache=True)(f)
+    except RuntimeError: return numba.njit(nogil=True)(f) # no writable cache location
+
+def _use_numba(use_numba=None): return numba is not None if use_numba is None else use_numba
+
+@_njit
+def _ridges_nb(labels, instlabels, c, instances, boxes):
+    "Sets the pixels of each instance to `c` if no pixel in the 3x3 neighborhood is `c` yet"
+    H, W = labels.shape
+    for n in range(len(instances)):
+        y0, y1, x0, x1 = boxes[n]
+        # Check all pixels before updating (as the dilation in `_ridges_np`)
+        free = np.zeros((y1-y0, x1-x0), dtype=np.bool_)
+        for y in range(y0, y1):
+            for x in range(x0, x1):
+                if instlabels[y, x]!=instances[n]: continue
+                free[y-y0, x-x0] = True
+                for yy in range(max(y-1, 0), min(y+2, H)):
+                    for xx in range(max(x-1, 0), min(x+2, W)):
+                        if labels[yy, xx]==c: free[y-y0, x-x0] = False
+        for y in range(y0, y1):
+            for x in range(x0, x1):
+                if free[y-y0, x-x0]: labels[y, x] = c
+
+def _ridges_np(labels, instlabels, c, instances, objects, kernel):
+    for instance in instances:
+        # Only the bounding box (plus a one pixel border for the 3x3 kernel) is affected by the instance
+        sl = tuple(slice(max(s.start-1, 0), s.stop+1) for s in objects[instance-1])
+        lbl = labels[sl]
+        objectMaskDil = cv2.dilate((lbl == c).astype('uint8'), kernel=kernel, iterations = 1)
+        lbl[(instlabels[sl] == instance) & (objectMaskDil == 0)] = c
+
+def _ridges(labels, instlabels, c, instances, objects, kernel, use_numba=None):
+    "Generates background ridges between touching `instances` of class `c` (in place)"
+    instances = [i for i in instances if 0<i<=len(objects) and objects[i-1] is not None]
+    if len(instances)==0: return
+    if _use_numba(use_numba) and kernel.shape==(3,3):
+        boxes = np.array([[s.start, s.stop, t.start, t.stop] for s,t in (objects[i-1] for i in instances)], dtype=np.int64)
+        _ridges_nb(labels, np.asarray(instlabels), c, np.array(instances, dtype=np.int64), boxes)
+    else: _ridges_np(labels, instlabels, c, instances, objects, kernel)
+
+# Cell
+@_njit
+def _pdf_nb(mask, lut, ignore):
+    "Looks up the weight of each pixel in `lut`, zero for `ignore` (empty if not given)"
+    pdf = np.empty(mask.size, dtype=np.float32)
+    for i in range(mask.size):
+        pdf[i] = 0 if ignore.size>0 and ignore[i] else lut[mask[i]]
+    return pdf
+
+def _class_pdf(mask, sampling_weights=None, ignore=None, use_numba=None):
+    "Pixel weights for the classes in `mask` (default: 1-class frequency), zero for `ignore`"
+    mask = np.ascontiguousarray(mask)
+    if mask.dtype==bool: mask = mask.view(np.uint8)
+    if sampling_weights is None:
+        counts = np.bincount(mask.ravel(), minlength=1)
+        sampling_weights = {k:1-v/mask.size for k,v in enumerate(counts) if v>0}
+    lut = np.zeros(max([int(mask.max(initial=0))]+list(sampling_weights.keys()))+1, dtype=np.float32)
+    for k, v in sampling_weights.items():
+        if k>=0: lut[k] = v
+    if _use_numba(use_numba):
+        ign = np.zeros(0, dtype=bool) if ignore is None else np.ascontiguousarray(ignore, dtype=bool).ravel()
+        return _pdf_nb(mask.ravel(), lut, ign).reshape(mask.shape)
+    pdf = lut[mask]
+    if ignore is not None: pdf[np.asarray(ignore, dtype=bool)] = 0
+    return pdf
+
+# Cell
+@_njit
+def _coords_nb(d, offs, factor, out):
+    "Fills `out` with `(d+offs)/factor` and returns its minimum and maximum"
+    lo, hi = np.inf, -np.inf
+    for y in range(d.shape[0]):
+        for x in range(d.shape[1]):
+            v = np.float32((d[y, x]+offs)/factor)
+            out[y, x] = v
+            lo, hi = min(lo, v), max(hi, v)
+    return lo, hi
+
+def _deform_coords(d, offs=0, factor=1, use_numba=None):
+    "Sampling coordinates `(d+offs)/factor` (float32) of a deformation field axis with their minimum and maximum"
+    if _use_numba(use_numba):
+        out = np.empty(d.shape, dtype=np.float32)
+        return (out,) + _coords_nb(d, float(offs), float(factor), out)
+    out = ((d+offs)/factor).astype('float32')
+    return out, out.min(), out.max()
+
 # Cell
 # adapted from Falk, Thorsten, et al. "U-Net: deep learning for cell counting, detection, and morphometry." Nature methods 16.1 (2019): 67-70.
 def preprocess_mask(clabels=None, instlabels=None, remove_connectivity=True, num_classes = 2):
@@ -138,6 +241,9 @@ def preprocess_mask(clabels=None, instlabels=None, remove_connectivity=True, num
                 instlabels[comps > 0] = comps[comps > 0] + nextInstance
                 nextInstance += nInstances
 
+        # Bounding boxes of all instances (index `instance-1`)
+        objects = ndimage.find_objects(np.asarray(instlabels).astype(np.int64, copy=False))
+        kernel = np.ones((3,) * num_classes)
         for c in classes:
             # Extract all instance labels of class c
             il = (instlabels * (clabels[:] == c)).astype(np.int16)
@@ -145,18 +251,42 @@ def preprocess_mask(clabels=None, instlabels=None, remove_connectivity=True, num
 
             # Generate background ridges between touching instances
             # of that class, avoid overlapping instances
-            dil = cv2.morphologyEx(il, cv2.MORPH_CLOSE, kernel=np.ones((3,) * num_classes))
+            dil = cv2.morphologyEx(il, cv2.MORPH_CLOSE, kernel=kernel)
             overlap_cand = np.unique(np.where(dil!=il, dil, 0))
             labels[np.isin(il, overlap_cand, invert=True)] = c
 
-            for instance in overlap_cand[1:]:
-                objectMaskDil = cv2.dilate((labels == c).astype('uint8'), kernel=np.ones((3,) * num_classes),iterations = 1)
-                labels[(instlabels == instance) & (objectMaskDil == 0)] = c
+            _ridges(labels, instlabels, c, overlap_cand[1:], objects, kernel)
     else:
         labels = clabels
 
     return labels#.astype(np.int32)
 
+# Cell
+# adapted from Falk, Thorsten, et al. "U-Net: deep learning for cell counting, detection, and morphometry." Nature methods 16.1 (2019): 67-70.
+def calculate_weights(labels, ignore=None, border_weight_sigma_px=6, border_weight_factor=50, foreground_background_ratio=1., truncate=4.):
+    "Calculates border-emphasizing weights from the distances to the nearest and second nearest instance of each class in `labels`."
+    labels = np.asarray(labels)
+    weights = np.full(labels.shape, foreground_background_ratio, dtype=np.float32)
+    # Instances further away than `truncate` sigmas contribute less than `border_weight_factor`*exp(-`truncate`**2)
+    r = int(np.ceil(truncate*border_weight_sigma_px))
+    for c in np.unique(labels)[1:]:
+        instances, _ = ndimage.label(labels==c)
+        min1dist = np.full(labels.shape, np.inf, dtype=np.float32)
+        min2dist = min1dist.copy()
+        for i, obj in enumerate(ndimage.find_objects(instances), start=1):
+            # Exact distances to instance i in its bounding box padded by r
+            sl = tuple(slice(max(s.start-r, 0), s.stop+r) for s in obj)
+            dt = ndimage.distance_transform_edt(instances[sl]!=i)
+            d1, d2 = min1dist[sl], min2dist[sl]
+            np.minimum(d2, np.maximum(d1, dt), out=d2)
+            np.minimum(d1, dt, out=d1)
+        weights += border_weight_factor*np.exp(-np.square(min1dist+min2dist)/border_weight_sigma_px**2)
+
+    # Set foreground weights to 1 and weights of ignored regions to 0
+    weights[labels>0] = 1
+    if ignore is not None: weights[np.asarray(ignore)] = 0
+    return weights
+
 # Cell
 # adapted from Falk, Thorsten, et al. "U-Net: deep learning for cell counting, detection, and morphometry." Nature methods 16.1 (2019): 67-70.
 class DeformationField:
@@ -207,16 +337,19 @@ class DeformationField:
         return [d + offs for (d, offs) in zip(deform, offset)]
 
 
-    def apply(self, data, offset=(0, 0), pad=(0, 0), order=1):
-        "Apply deformation field to image using interpolation"
+    def apply(self, data, offset=(0, 0), pad=(0, 0), order=1, factor=1):
+        "Apply deformation field to image using interpolation, `data` can be a pyramid level downsampled by `factor`"
 
         outshape = tuple(int(s - p) for (s, p) in zip(self.shape, pad))
-        coords = [np.squeeze(d).astype('float32').reshape(*outshape) for d in self.get(offset, pad)]
+        sliceDef = tuple(slice(int(p / 2), int(-p / 2)) if p > 0 else slice(None) for p in pad)
+        # Pixel j of a level is centred at j*factor+(factor-1)/2 in full resolution (see `_downsample`)
+        coords, cmins, cmaxs = zip(*[_deform_coords(d[sliceDef], offs-(factor-1)/2, factor) for (d, offs) in zip(self.deformationField, offset)])
+        coords = [c.reshape(*outshape) for c in coords]
 
         # Get slices to avoid loading all data (.zarr files)
         sl = []
         for i in range(len(coords)):
-            cmin, cmax = int(coords[i].min()), int(coords[i].max())
+            cmin, cmax = int(cmins[i]), int(cmaxs[i])
             dmax = data.shape[i]
             if cmin<0:
                 cmax = max(-cmin, cmax)
@@ -235,10 +368,68 @@ class DeformationField:
         return remap_fn(data[tuple(sl)])
 
 # Cell
+class _TiffChunkStore(MutableMapping):
+    "Read-only wrapper of a tifffile `ZarrTiffStore` that reports all chunks as present (newer zarr versions skip unlisted chunks)"
+    def __init__(self, store): self.store = store
+    def __getitem__(self, key): return self.store[key]
+    def __contains__(self, key): return key in self.store or all(k.isdigit() for k in key.split('.'))
+    def __iter__(self): return iter(self.store)
+    def __len__(self): return len(self.store)
+    def __setitem__(self, key, value): raise PermissionError('Read-only store')
+    def __delitem__(self, key): raise PermissionError('Read-only store')
+
+class LazyTiff:
+    "Array-like (height, width, channels) view of a tiled or BigTIFF image that only reads the requested region from disk"
+    ndim = 3
+    def __init__(self, path):
+        self.path = Path(path)
+        self._open()
+
+    def _open(self):
+        self._tif = tifffile.TiffFile(self.path)
+        series = self._tif.series[0]
+        self.arr, self.axes = zarr.open(_TiffChunkStore(series.aszarr(level=0)), mode='r'), series.axes
+        assert 'Y' in self.axes and 'X' in self.axes, f'Unsupported axes {self.axes}'
+        dims = dict(zip(self.axes, self.arr.shape))
+        self.shape = (dims['Y'], dims['X'], int(np.prod([v for k,v in dims.items() if k not in 'YX'])))
+        self.dtype = self.arr.dtype
+
+    # Workers reopen the file
+    def __getstate__(self): return {'path': self.path}
+    def __setstate__(self, state): self.__init__(**state)
+
+    def __getitem__(self, sl):
+        sl = sl if isinstance(sl, tuple) else (sl,)
+        if Ellipsis in sl:
+            i = sl.index(Ellipsis)
+            sl = sl[:i] + (slice(None),)*(4-len(sl)) + sl[i+1:]
+        sl = sl + (slice(None),)*(3-len(sl))
+        assert all(isinstance(s, slice) for s in sl[:2]), 'Only slices are supported for height and width'
+        x = self.arr[tuple(sl[0] if a=='Y' else sl[1] if a=='X' else slice(None) for a in self.axes)]
+        x = np.moveaxis(x, [self.axes.index('Y'), self.axes.index('X')], [0, 1])
+        return x.reshape(*x.shape[:2], -1)[..., sl[2]]
+
+    def __array__(self, dtype=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+    def close(self): self._tif.close()
+    def __del__(self):
+        if hasattr(self, '_tif'): self.close()
+
+    def __repr__(self): return f'{self.__class__.__name__}({self.path.name}, shape={self.shape}, dtype={self.dtype})'
+
+# Cell
+def _is_lazy_tiff(path):
+    "Checks if `path` is a tiled or BigTIFF image that should be read lazily"
+    if path.suffix.lower() not in ['.tif', '.tiff']: return False
+    with tifffile.TiffFile(path) as tif: return tif.is_bigtiff or tif.pages[0].is_tiled
+
 def _read_img(path, **kwargs):
     "Read image"
     if path.suffix == '.zarr':
         img = zarr.convenience.open(path.as_posix())
+    elif _is_lazy_tiff(path):
+        img = LazyTiff(path)
     else:
         img = imageio.imread(path, **kwargs)
         #if img.max()>1.:
@@ -247,6 +438,27 @@ def _read_img(path, **kwargs):
             img = np.expand_dims(img, axis=2)
     return img
 
+# Cell
+def _read_shape(path):
+    "Reads the (height, width) of image `path` from the file header, returns None if the image needs to be decoded"
+    if path.suffix == '.zarr': return tuple(zarr.convenience.open(path.as_posix(), mode='r').shape[:2])
+    if path.suffix.lower() in ['.tif', '.tiff']:
+        with tifffile.TiffFile(path) as tif:
+            series = tif.series[0]
+            if series.axes not in ['YX', 'YXS']: return None
+            return tuple(series.shape[:2])
+    try:
+        with Image.open(path) as im: return (im.height, im.width)
+    except Exception: return None
+
+# Cell
+def _write_array(group, name, arr, chunks, **kwargs):
+    "Writes `arr` to zarr `group`, copying lazily read arrays one row of chunks at a time"
+    if isinstance(arr, np.ndarray): return group.array(name, arr, chunks=chunks, **kwargs)
+    z = group.empty(name, shape=arr.shape, dtype=arr.dtype, chunks=chunks, **kwargs)
+    for y in range(0, arr.shape[0], chunks[0]): z[y:y+chunks[0]] = arr[y:y+chunks[0]]
+    return z
+
 # Cell
 def _read_msk(path, num_classes=2, instance_labels=False, remove_connectivity=True, **kwargs):
     "Read image and check classes"
@@ -269,6 +481,220 @@ def _read_msk(path, num_classes=2, instance_labels=False, remove_connectivity=Tr
     assert len(msk.shape)==2, 'Currently, only masks with a single channel are supported.'
     return msk.astype('uint8')
 
+# Cell
+def _downsample(x, factor=2, mask=False):
+    "Downsamples `x` (height, width, ...) by integer `factor` using block averages (images) or majorities (masks), level pixel j is centred at j*factor+(factor-1)/2"
+    h, w = (x.shape[0]//factor)*factor, (x.shape[1]//factor)*factor
+    blocks = x[:h, :w].reshape(h//factor, factor, w//factor, factor, *x.shape[2:])
+    if mask:
+        n = int(x.max())+1 if x.size else 1
+        return np.argmax([(blocks==c).sum((1,3)) for c in range(n)], axis=0).astype(x.dtype)
+    y = blocks.mean((1,3))
+    return np.round(y).astype(x.dtype) if np.issubdtype(x.dtype, np.integer) else y.astype(x.dtype)
+
+def _write_pyramid(group, name, arr, factors, chunks, mask=False, **kwargs):
+    "Writes the levels `factors` (increasing powers of 2) of `arr` to `group`/factor/`name`, each computed from the previous level"
+    src, level = arr, 1
+    for f in factors:
+        step = f//level
+        shape = (src.shape[0]//step, src.shape[1]//step, *src.shape[2:])
+        dst = group.require_group(str(f)).empty(name, shape=shape, dtype=src.dtype, chunks=chunks[:len(shape)], **kwargs)
+        rows = chunks[0]*step
+        for y in range(0, shape[0]*step, rows):
+            dst[y//step:(y+rows)//step] = _downsample(np.asarray(src[y:y+rows, :shape[1]*step]), step, mask)
+        src, level = dst, f
+
+# Cell
+class SharedArrayCache:
+    "LRU cache with a budget of `max_bytes` that keeps arrays in shared memory blocks visible to all DataLoader workers"
+    _meta = np.dtype([('key', 'S32'), ('tick', 'i8'), ('nbytes', 'i8'), ('dtype', 'S8'), ('ndim', 'i8'), ('shape', 'i8', 4)])
+    def __init__(self, max_bytes, max_items=4096):
+        assert shared_memory is not None, 'SharedArrayCache requires python>=3.8'
+        if os.path.isdir('/dev/shm') and shutil.disk_usage('/dev/shm').free<max_bytes:
+            max_bytes = shutil.disk_usage('/dev/shm').free
+            warnings.warn(f'Reducing cache size to the available shared memory ({max_bytes/2**30:.2f} GB).')
+        self.max_bytes, self.max_items = int(max_bytes), max_items
+        self.prefix = f'df2_{secrets.token_hex(4)}'
+        # Spawned processes (e.g., parallel training jobs) attach to the cache, which requires a lock of the spawn context
+        self.lock = mp.get_context('spawn').Lock()
+        # Workers inherit the tracker of the main process, otherwise blocks are unlinked when a worker exits
+        resource_tracker.ensure_running()
+        self._owner = os.getpid()
+        self._shm = shared_memory.SharedMemory(create=True, size=16+self._meta.itemsize*max_items)
+        self._attach()
+        self._counter[:], self._index[:] = 0, np.zeros(max_items, self._meta)
+        # Runs on garbage collection or at interpreter exit
+        self._finalizer = weakref.finalize(self, self._release, self._shm.name, self.prefix, max_items, self._owner)
+
+    @classmethod
+    def _release(cls, name, prefix, max_items, owner):
+        "Unlinks all cached arrays and the index, only in the `owner` process"
+        if os.getpid()!=owner: return
+        shm = shared_memory.SharedMemory(name=name)
+        keys = np.ndarray((max_items,), dtype=cls._meta, buffer=shm.buf, offset=16)['key'].tolist()
+        for k in filter(None, keys):
+            try: block = shared_memory.SharedMemory(name=f'{prefix}_{k[:16].decode()}')
+            except FileNotFoundError: continue
+            block.close(); block.unlink()
+        shm.close(); shm.unlink()
+
+    def _attach(self):
+        self._handles = {}
+        # Global access counter and total bytes, followed by one index row per cached array
+        self._counter = np.ndarray((2,), dtype=np.int64, buffer=self._shm.buf)
+        self._index = np.ndarray((self.max_items,), dtype=self._meta, buffer=self._shm.buf, offset=16)
+
+    def __getstate__(self):
+        state = {k:v for k,v in self.__dict__.items() if k not in ('_shm', '_handles', '_counter', '_index', '_finalizer')}
+        return {**state, '_shm_name': self._shm.name}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shm = shared_memory.SharedMemory(name=self._shm_name)
+        self._attach()
+
+    def _key(self, key): return hashlib.md5(key.encode()).hexdigest().encode()
+    def _block_name(self, k): return f'{self.prefix}_{k[:16].decode()}'
+    def _find(self, k): return np.flatnonzero(self._index['key']==k)
+    def __contains__(self, key): return len(self._find(self._key(key)))>0
+    def __len__(self): return int((self._index['key']!=b'').sum())
+
+    @property
+    def nbytes(self): return int(self._counter[1])
+
+    def _view(self, k, meta):
+        if k not in self._handles: self._handles[k] = shared_memory.SharedMemory(name=self._block_name(k))
+        shape = tuple(meta['shape'][:meta['ndim']])
+        arr = np.ndarray(shape, dtype=meta['dtype'].decode(), buffer=self._handles[k].buf)
+        arr.flags.writeable = False # shared between processes
+        return arr
+
+    def _prune(self):
+        "Releases local handles of arrays that were evicted by any process"
+        for k in set(self._handles)-set(self._index['key'].tolist()):
+            try: self._handles[k].close()
+            except BufferError: continue # still in use
+            del self._handles[k]
+
+    def _evict(self, nbytes):
+        "Removes least recently used arrays until `nbytes` fit into the cache"
+        used = self._index['key']!=b''
+        while used.any() and (self._counter[1]+nbytes>self.max_bytes or used.all()):
+            i = np.flatnonzero(used)[np.argmin(self._index['tick'][used])]
+            shm = shared_memory.SharedMemory(name=self._block_name(self._index['key'][i]))
+            shm.unlink()
+            shm.close()
+            self._counter[1] -= self._index['nbytes'][i]
+            self._index[i] = np.zeros(1, self._meta)[0]
+            used[i] = False
+
+    def _insert(self, k, arr):
+        with self.lock:
+            self._prune()
+            idx = self._find(k)
+            # Another process may have loaded the array in the meantime
+            if len(idx)==0:
+                self._evict(arr.nbytes)
+                shm = shared_memory.SharedMemory(name=self._block_name(k), create=True, size=max(arr.nbytes, 1))
+                np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+                self._handles[k] = shm
+                self._counter += (1, arr.nbytes)
+                idx = np.flatnonzero(self._index['key']==b'')[:1]
+                self._index[idx] = (k, self._counter[0], arr.nbytes, arr.dtype.str, arr.ndim, arr.shape+(0,)*(4-arr.ndim))
+            return self._view(k, self._index[idx[0]].copy())
+
+    def get(self, key, load_fn):
+        "Returns the array cached under `key`, calling `load_fn` to load it on a miss, lazy arrays (e.g., zarr) that do not fit are returned undecoded"
+        k = self._key(key)
+        with self.lock:
+            idx = self._find(k)
+            if len(idx)>0:
+                self._counter[0] += 1
+                self._index['tick'][idx] = self._counter[0]
+                meta = self._index[idx[0]].copy()
+        if len(idx)>0:
+            try: return self._view(k, meta)
+            except FileNotFoundError: pass # evicted by another process in the meantime
+        arr = load_fn()
+        # Size from the metadata, only arrays that fit are decoded
+        if int(np.prod(arr.shape))*np.dtype(arr.dtype).itemsize>self.max_bytes or len(arr.shape)>4: return arr
+        return self._insert(k, np.ascontiguousarray(arr))
+
+    def clear(self):
+        "Removes all arrays from the cache"
+        with self.lock: self._evict(self.max_bytes+1)
+        self._prune()
+
+    def close(self):
+        "Removes all arrays and releases the shared memory of the cache index"
+        if not hasattr(self, '_index'): return
+        self.clear()
+        del self._counter, self._index
+        self._shm.close()
+        if os.getpid()==self._owner:
+            self._shm.unlink()
+            self._finalizer.detach()
+
+# Cell
+class SharedMemoryDataset:
+    "Read-only mapping of the arrays `keys` in zarr `group`, loaded once into shared memory and attached as NumPy views in all processes"
+    def __init__(self, group, keys=None):
+        assert shared_memory is not None, 'SharedMemoryDataset requires python>=3.8'
+        keys = list(group.array_keys()) if keys is None else keys
+        prefix = f'df2_{secrets.token_hex(4)}'
+        resource_tracker.ensure_running()
+        self._owner = os.getpid()
+        self._names, self._meta, self._blocks = {}, {}, {}
+        for i, k in enumerate(keys):
+            arr = group[k]
+            shm = shared_memory.SharedMemory(name=f'{prefix}_{i}', create=True, size=max(arr.nbytes, 1))
+            # Decompress directly into the shared block
+            arr.get_basic_selection(Ellipsis, out=np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf))
+            self._names[k], self._meta[k], self._blocks[k] = shm.name, (arr.shape, arr.dtype.str), shm
+        self._views = {}
+        self._finalizer = weakref.finalize(self, self._release, list(self._names.values()), self._owner)
+
+    @staticmethod
+    def _release(names, owner):
+        "Unlinks all blocks, only in the `owner` process"
+        if os.getpid()!=owner: return
+        for name in names:
+            try: shm = shared_memory.SharedMemory(name=name)
+            except FileNotFoundError: continue
+            shm.close(); shm.unlink()
+
+    def __getstate__(self):
+        # Only block names are sent to worker processes
+        return {k:v for k,v in self.__dict__.items() if k not in ('_blocks', '_views', '_finalizer')}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._blocks, self._views = {}, {}
+
+    def __getitem__(self, key):
+        if key not in self._views:
+            if key not in self._blocks: self._blocks[key] = shared_memory.SharedMemory(name=self._names[key])
+            shape, dtype = self._meta[key]
+            arr = np.ndarray(shape, dtype=dtype, buffer=self._blocks[key].buf)
+            arr.flags.writeable = False
+            self._views[key] = arr
+        return self._views[key]
+
+    def __contains__(self, key): return key in self._names
+    def __iter__(self): return iter(self._names)
+    def __len__(self): return len(self._names)
+    def keys(self): return self._names.keys()
+
+    @property
+    def nbytes(self): return sum(np.prod(s)*np.dtype(d).itemsize for s,d in self._meta.values())
+
+    def close(self):
+        "Releases the views and, in the owner process, frees the shared memory"
+        self._views = {}
+        for shm in self._blocks.values(): shm.close()
+        self._blocks = {}
+        if os.getpid()==self._owner: self._finalizer()
+
 # Cell
 def tiles_in_rectangles(H, W, h, w):
     '''Get smaller rectangles needed to fill the larger rectangle'''
@@ -278,30 +704,215 @@ def tiles_in_rectangles(H, W, h, w):
 
     return n_H*n_W
 
+# Cell
+class MaskCodec(Codec):
+    "Lossless filter for 1-byte masks that bit-packs binary chunks and run-length encodes chunks with few runs"
+    codec_id = 'deepflash2_mask'
+
+    def encode(self, buf):
+        x = ensure_ndarray(buf).reshape(-1).view('u1')
+        head = np.array([len(x)], dtype='<u8').tobytes()
+        if len(x)==0: return b'\x00'+head
+        starts = np.flatnonzero(x[1:]!=x[:-1])+1
+        rle_nbytes = 5*(len(starts)+1)
+        if x.max()<=1 and (len(x)+7)//8<=rle_nbytes: return b'\x01'+head+np.packbits(x).tobytes()
+        if rle_nbytes<len(x):
+            lengths = np.diff(np.concatenate([[0], starts, [len(x)]])).astype('<u4')
+            return b'\x02'+head+x[np.concatenate([[0], starts])].tobytes()+lengths.tobytes()
+        return b'\x00'+head+x.tobytes()
+
+    def decode(self, buf, out=None):
+        b = ensure_bytes(buf)
+        mode, n = b[0], int(np.frombuffer(b, dtype='<u8', count=1, offset=1)[0])
+        data = np.frombuffer(b, dtype='u1', offset=9)
+        if mode==1: x = np.unpackbits(data, count=n)
+        elif mode==2:
+            r = len(data)//5
+            x = np.repeat(data[:r], np.frombuffer(b, dtype='<u4', offset=9+r))
+        else: x = data
+        return ndarray_copy(x, out)
+
+register_codec(MaskCodec)
+
+# Cell
+_compressor_dict = {
+    'lz4' : Blosc(cname='lz4', clevel=5, shuffle=Blosc.SHUFFLE),
+    'zstd' : Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE),
+    'none' : None,
+}
+
+def _tile_chunks(shape, tile_shape=(512,512), scale=1.):
+    "Chunk shape for an array of `shape` such that a (rotated) tile only touches a few chunks"
+    chunks = tuple(int(min(max(t*scale//2, 64), s)) for t, s in zip(tile_shape, shape))
+    return chunks + tuple(shape[len(chunks):])
+
+def _file_fingerprint(*paths, **kwargs):
+    "Hash of file sizes, modification times and preprocessing settings (`kwargs`)"
+    stats = [(p.stat().st_size, p.stat().st_mtime_ns) for p in map(Path, paths)]
+    return hashlib.md5(repr((stats, sorted(kwargs.items()))).encode()).hexdigest()
+
+# Cell
+class ChannelStats:
+    "Mergeable pixel count, mean and sum of squared deviations per channel (Chan et al. parallel algorithm)"
+    def __init__(self, n=0, mean=0., m2=0.):
+        self.n, self.mean, self.m2 = int(n), np.asarray(mean, dtype='float64'), np.asarray(m2, dtype='float64')
+
+    def merge(self, other):
+        "Adds the statistics of `other` in place"
+        if other.n==0: return self
+        n, delta = self.n+other.n, other.mean-self.mean
+        self.mean = self.mean + delta*other.n/n
+        self.m2 = self.m2 + other.m2 + delta**2*self.n*other.n/n
+        self.n = n
+        return self
+
+    def update(self, x):
+        "Adds the pixels of `x` (..., channels)"
+        x = np.asarray(x, dtype='float64').reshape(-1, x.shape[-1])
+        if len(x)==0: return self
+        mean = x.mean(0)
+        return self.merge(ChannelStats(len(x), mean, ((x-mean)**2).sum(0)))
+
+    @property
+    def var(self): return self.m2/max(self.n, 1)
+    @property
+    def std(self): return np.sqrt(self.var)
+    def to_dict(self): return {'n':self.n, 'mean':self.mean.tolist(), 'm2':self.m2.tolist()}
+
+# Cell
+def channel_stats(arr, chunks=None, max_chunks=None, seed=0):
+    "`ChannelStats` of `arr` (H,W,C) computed chunk by chunk, optionally on a random subsample of `max_chunks` chunks"
+    chunks = chunks or getattr(arr, 'chunks', arr.shape)
+    starts = [(y,x) for y in range(0, arr.shape[0], chunks[0]) for x in range(0, arr.shape[1], chunks[1])]
+    if max_chunks is not None and len(starts)>max_chunks:
+        idx = np.random.default_rng(seed).choice(len(starts), max_chunks, replace=False)
+        starts = [starts[i] for i in sorted(idx)]
+    stats = ChannelStats()
+    for y,x in starts: stats.update(arr[y:y+chunks[0], x:x+chunks[1]])
+    return stats
+
+# Cell
+def _grid_cells(shape, grid_shape):
+    "Cell shape of a grid with `grid_shape` cells that evenly covers an array of `shape`"
+    return tuple(-(-s//g) for s, g in zip(shape[:2], grid_shape[:2]))
+
+def _class_grid(lbl, cell_shape, num_classes, ignore=None):
+    "Pixel counts per class (last axis) in a grid of cells of about `cell_shape`, excluding `ignore`d pixels"
+    grid_shape = tuple(-(-s//c) for s, c in zip(lbl.shape[:2], cell_shape))
+    ch, cw = _grid_cells(lbl.shape, grid_shape)
+    cols = np.arange(lbl.shape[1])//cw
+    grid = np.zeros(grid_shape+(num_classes,), dtype=np.int32)
+    # One row of cells at a time
+    for i in range(grid_shape[0]):
+        x = cols*num_classes + np.asarray(lbl[i*ch:(i+1)*ch], dtype=np.int64)
+        if ignore is not None: x = x[~np.asarray(ignore[i*ch:(i+1)*ch], dtype=bool)]
+        grid[i] = np.bincount(x.ravel(), minlength=grid_shape[1]*num_classes).reshape(grid_shape[1], num_classes)
+    return grid
+
 # Cell
 class BaseDataset(Dataset):
     def __init__(self, files, label_fn=None, instance_labels = False, num_classes=2, ignore={},remove_connectivity=True,
                  stats=None,normalize=True, use_zarr_data=True,
-                 tile_shape=(512,512), padding=(0,0),preproc_dir=None, verbose=1, scale=1, pdf_reshape=512, use_preprocessed_labels=False, **kwargs):
-        store_attr('files, label_fn, instance_labels, num_classes, ignore, tile_shape, remove_connectivity, padding, preproc_dir, stats, normalize, scale, pdf_reshape, use_preprocessed_labels')
+                 tile_shape=(512,512), padding=(0,0),preproc_dir=None, verbose=1, scale=1, pdf_reshape=512, use_preprocessed_labels=False,
+                 compressor='lz4', cache=None, backend='zarr', stats_max_chunks=None, pyramid=False, weights=False, weight_kwargs=None, sampling='cdf', read_only=False, shared_arrays=None, **kwargs):
+        store_attr('files, label_fn, instance_labels, num_classes, ignore, tile_shape, remove_connectivity, padding, preproc_dir, stats, normalize, scale, pdf_reshape, use_preprocessed_labels, compressor, backend, stats_max_chunks, pyramid, weights, sampling, read_only')
+        assert compressor in _compressor_dict, f'Select one of {list(_compressor_dict)}'
+        assert backend in ['zarr', 'shared_memory'], "Select one of ['zarr', 'shared_memory']"
+        assert sampling in ['cdf', 'grid', 'balanced'], "Select one of ['cdf', 'grid', 'balanced']"
         self.c = num_classes
         self.use_zarr_data=False
-
-        if self.stats is None:
-            self.mean_sum, self.var_sum = 0., 0.
-            self.max_tile_count = 0
-            self.actual_tile_shape = (np.array(self.tile_shape)-np.array(self.padding))
+        self.actual_tile_shape = (np.array(self.tile_shape)-np.array(self.padding))
+        # `cache` can be a SharedArrayCache (e.g., shared between datasets) or a budget in bytes
+        if isinstance(cache, (int, float)): cache = SharedArrayCache(cache) if cache>0 else None
+        self.cache = cache
+        self.weight_kwargs = weight_kwargs or {}
+        # Downsampling factors of the precomputed levels for `scale`>=2 (created during preprocessing)
+        self.pyramid_factors = [2**k for k in range(1, int(np.log2(scale))+1)] if pyramid and scale>=2 and label_fn is not None else []
 
         if label_fn is not None:
             self.preproc_dir = self.preproc_dir or zarr.storage.TempStore()
-            root = zarr.group(store=self.preproc_dir, overwrite= not use_preprocessed_labels)
-            self.data, self.labels, self.pdfs  = root.require_groups('data', 'labels','pdfs')
+            if isinstance(self.preproc_dir, Path): self.preproc_dir = self.preproc_dir.as_posix()
+            # Ignore maps may be stored in the store that `overwrite` clears (e.g., passed on by `EnsembleLearner`)
+            if not use_preprocessed_labels:
+                self.ignore = {k:np.asarray(v[:], dtype=bool) if isinstance(v, zarr.Array) else v for k,v in self.ignore.items()}
+            self._open_store(consolidated=use_preprocessed_labels, overwrite=not use_preprocessed_labels)
+            if self.ignore: self._store_ignore()
             self._preproc(use_zarr_data=use_zarr_data, verbose=verbose)
+            if backend=='shared_memory': self._to_shared_memory(shared_arrays)
+
+    def _open_store(self, consolidated=True, overwrite=False):
+        "Opens the groups of the preprocessed data store, reading all metadata from a single key if `consolidated`"
+        root = None
+        if consolidated:
+            try: root = zarr.open_consolidated(self.preproc_dir, mode='r' if self.read_only else 'r+')
+            except KeyError: pass
+        groups = ('data', 'labels','pdfs', 'pyramid', 'weights', 'grids')
+        if root is None or not all(g in root for g in groups):
+            assert not self.read_only, f'No preprocessed data in {self.preproc_dir}'
+            root = zarr.group(store=self.preproc_dir, overwrite=overwrite)
+        self.data, self.labels, self.pdfs, self.levels, self.weight_maps, self.grids = root.require_groups(*groups)
+
+    def _store_ignore(self):
+        "Moves the `ignore` maps of `files` to the store (compactly encoded), replacing them by arrays that decode only the requested regions"
+        if self.read_only: group = zarr.open_group(self.preproc_dir, mode='r')['ignore']
+        else: group = zarr.open_group(self.preproc_dir, mode='a').require_group('ignore')
+        names = [f.name for f in self.files if f.name in self.ignore]
+        for name in names:
+            ign = self.ignore[name]
+            if self.read_only or (isinstance(ign, zarr.Array) and ign.store==group.store and ign.path==f'ignore/{name}'): continue
+            ign = np.asarray(ign[:], dtype=bool)
+            # Unchanged maps are not rewritten, other processes may be reading them
+            md5 = hashlib.md5(repr(ign.shape).encode()+np.packbits(ign).tobytes()).hexdigest()
+            if name in group and group[name].attrs.get('md5')==md5: continue
+            arr = group.array(name, ign, chunks=_tile_chunks(ign.shape, self.tile_shape, self.scale), filters=[MaskCodec()],
+                              compressor=_compressor_dict[self.compressor], overwrite=True)
+            arr.attrs['md5'] = md5
+        self.ignore = {**self.ignore, **{name:group[name] for name in names}}
+
+    def _to_shared_memory(self, shared_arrays=None):
+        "Loads the preprocessed arrays of `files` into shared memory, or attaches to the `shared_arrays` of another dataset if they contain all files"
+        names = [f.name for f in self.files]
+        if shared_arrays and all(n in shared_arrays['labels'] for n in names):
+            for k,v in shared_arrays.items(): setattr(self, k, v)
+            return
+        self.labels = SharedMemoryDataset(self.labels, names)
+        if self.sampling=='cdf': self.pdfs = SharedMemoryDataset(self.pdfs, names)
+        else: self.grids = SharedMemoryDataset(self.grids, names)
+        if self.use_zarr_data: self.data = SharedMemoryDataset(self.data, names)
+        if self.weights: self.weight_maps = SharedMemoryDataset(self.weight_maps, names)
+        if self.pyramid_factors:
+            self.levels = SharedMemoryDataset(self.levels, [f'{g}/{f}/{n}' for g in ('data', 'labels') for f in self.pyramid_factors for n in names])
+
+    @property
+    def shared_arrays(self):
+        "Preprocessed groups in shared memory by attribute name, e.g., for `shared_arrays` of other datasets"
+        return {k:getattr(self, k) for k in ('data', 'labels', 'pdfs', 'grids', 'weight_maps', 'levels') if isinstance(getattr(self, k, None), SharedMemoryDataset)}
 
     def read_img(self, path, **kwargs):
-        if self.use_zarr_data: img = self.data[path.name]
-        else: img = _read_img(path, **kwargs)
-        return img
+        if self.use_zarr_data: load_fn = lambda: self.data[path.name]
+        else: load_fn = lambda: _read_img(path, **kwargs)
+        if self.cache is None or isinstance(getattr(self, 'data', None), SharedMemoryDataset): return load_fn()
+        return self.cache.get(f'images/{path.as_posix()}', load_fn)
+
+    def read_shape(self, path):
+        "Returns (height, width) of image `path` without decoding the pixels if possible"
+        if self.use_zarr_data: return tuple(self.data[path.name].shape[:2])
+        return _read_shape(path) or tuple(self.read_img(path).shape[:2])
+
+    def _pyramid_factor(self, scale):
+        "Largest precomputed downsampling factor that does not exceed `scale`"
+        return max([1]+[f for f in self.pyramid_factors if f<=scale])
+
+    def read_level(self, path, factor=1, mask=False):
+        "Reads the image (or label if `mask`) of `path` from the pyramid level downsampled by `factor`"
+        if factor==1: return self._read_preproc('labels', path.name) if mask else self.read_img(path)
+        return self._read_preproc('levels', f"{'labels' if mask else 'data'}/{factor}/{path.name}")
+
+    def _read_preproc(self, group, name):
+        "Returns array `name` from the preprocessed `group` ('labels', 'pdfs', 'grids', 'levels', 'weight_maps' or 'tiles'), via the cache if available"
+        arr = getattr(self, group)
+        if self.cache is None or isinstance(arr, SharedMemoryDataset): return arr[name]
+        return self.cache.get(f'{group}/{name}', lambda: arr[name])
 
     def read_mask(self, *args, **kwargs):
         return _read_msk(*args, **kwargs)
@@ -312,19 +923,8 @@ class BaseDataset(Dataset):
         # Create mask
         mask = mask[:]
 
-        if sampling_weights is None:
-            classes, counts = np.unique(mask, return_counts=True)
-            sampling_weights = {k:1-v/mask.size for k,v in zip(classes, counts)}
-
-        # Set pixel weights
-        pdf = np.zeros_like(mask, dtype=np.float32)
-        for k, v in sampling_weights.items():
-            pdf[mask==k] = v
-
-
-        # Set weight and sampling probability for ignored regions to 0
-        if ignore is not None:
-            pdf[ignore[:]] = 0
+        # Set pixel weights, weight and sampling probability for ignored regions to 0
+        pdf = _class_pdf(mask, sampling_weights, None if ignore is None else ignore[:])
 
         if igonore_edges_pct>0:
             w = int(self.tile_shape[0]*igonore_edges_pct/2) #0.25
@@ -340,52 +940,82 @@ class BaseDataset(Dataset):
 
         return np.cumsum(pdf/np.sum(pdf))
 
+    def _fingerprint(self, file):
+        "Fingerprint of `file`, its label and the preprocessing settings"
+        ign = self.ignore[file.name] if file.name in self.ignore else None
+        ign = hashlib.md5(np.ascontiguousarray(ign[:])).hexdigest() if ign is not None else None
+        return _file_fingerprint(file, self.label_fn(file), num_classes=self.c, instance_labels=self.instance_labels,
+                                 remove_connectivity=self.remove_connectivity, pdf_reshape=self.pdf_reshape, ignore=ign,
+                                 stats_max_chunks=self.stats_max_chunks, **({'pyramid':self.pyramid_factors} if self.pyramid_factors else {}),
+                                 **({'weights':sorted(self.weight_kwargs.items())} if self.weights else {}))
+
+    @property
+    def _sampling_index(self):
+        "Preprocessed group for `sampling`: full-resolution CDFs ('cdf') or class counts per label chunk ('grid', 'balanced')"
+        return self.pdfs if self.sampling=='cdf' else self.grids
+
+    def _is_cached(self, file, use_zarr_data=True):
+        "Checks if up-to-date preprocessed data of `file` is available"
+        if use_zarr_data and file.name not in self.data: return False
+        if file.name not in self.labels or file.name not in self._sampling_index: return False
+        if self.weights and file.name not in self.weight_maps: return False
+        return self.labels[file.name].attrs.get('fingerprint')==self._fingerprint(file)
+
     def _preproc_file(self, file, use_zarr_data=True):
-        "Preprocesses and saves images, labels (msk), weights, and pdf."
+        "Preprocesses and saves images, labels (msk), weights, and the sampling index (pdf or class grid)."
 
         # Load and save image
         img = self.read_img(file)
-
-        if self.stats is None:
-            self.mean_sum += img.mean((0,1))
-            self.var_sum += img.var((0,1))
-            self.max_tile_count = max(self.max_tile_count, tiles_in_rectangles(*img.shape[:2], *self.actual_tile_shape))
-        if use_zarr_data: self.data[file.name] = img
+        zarr_kwargs = {'compressor':_compressor_dict[self.compressor], 'overwrite':True}
+        if use_zarr_data:
+            _write_array(self.data, file.name, img, _tile_chunks(img.shape, self.tile_shape, self.scale), **zarr_kwargs)
 
         if self.label_fn is not None:
             # Load and save image
             label_path = self.label_fn(file)
             ign = self.ignore[file.name] if file.name in self.ignore else None
             lbl = self.read_mask(label_path,  num_classes=self.c, instance_labels=self.instance_labels, remove_connectivity=self.remove_connectivity)
-            self.labels[file.name] = lbl
-            self.pdfs[file.name] = self._create_cdf(lbl, ignore=ign)
+            self.labels.array(file.name, lbl, chunks=_tile_chunks(lbl.shape, self.tile_shape, self.scale), filters=[MaskCodec()], **zarr_kwargs)
+            # Only the index of `sampling`, an index of another mode would be outdated with the new label
+            if self.sampling=='cdf': self.pdfs.array(file.name, self._create_cdf(lbl, ignore=ign), **zarr_kwargs)
+            else: self.grids.array(file.name, _class_grid(lbl, _tile_chunks(lbl.shape, self.tile_shape, self.scale), self.c, ign), **zarr_kwargs)
+            other = self.grids if self.sampling=='cdf' else self.pdfs
+            if file.name in other: del other[file.name]
+            if self.weights:
+                wgt = calculate_weights(lbl, ignore=ign[:] if ign is not None else None, **self.weight_kwargs)
+                self.weight_maps.array(file.name, wgt, chunks=_tile_chunks(wgt.shape, self.tile_shape, self.scale), **zarr_kwargs)
+            if self.pyramid_factors:
+                _write_pyramid(self.levels.require_group('data'), file.name, img, self.pyramid_factors,
+                               _tile_chunks(img.shape, self.tile_shape), **zarr_kwargs)
+                _write_pyramid(self.levels.require_group('labels'), file.name, lbl, self.pyramid_factors,
+                               _tile_chunks(lbl.shape, self.tile_shape), mask=True, filters=[MaskCodec()], **zarr_kwargs)
+            # Image stats and fingerprint (written last to invalidate interrupted preprocessing)
+            stats = channel_stats(img, _tile_chunks(img.shape, self.tile_shape, self.scale), self.stats_max_chunks)
+            self.labels[file.name].attrs.update({'shape': img.shape,
+                                                 'channel_stats': stats.to_dict(),
+                                                 'fingerprint': self._fingerprint(file)})
 
     def _preproc(self, use_zarr_data=True, verbose=0):
-        using_cache = False
-        if verbose>0: print('Preprocessing data')
-        for f in progress_bar(self.files, leave=True if verbose>0 else False):
-            if self.use_preprocessed_labels:
-                try:
-                    self.data[f.name]
-                    if self.label_fn is not None:
-                        self.labels[f.name]
-                        self.pdfs[f.name]
-                        if not using_cache:
-                            #if verbose>0: print(f'Using preprocessed data from {self.preproc_dir}')
-                            using_cache = True
-                except:
-                    self._preproc_file(f, use_zarr_data=use_zarr_data)
-            else:
+        files = [f for f in self.files if not (self.use_preprocessed_labels and self._is_cached(f, use_zarr_data))]
+        assert not (self.read_only and files), f'Preprocessed data of {len(files)} files is missing or outdated in {self.preproc_dir}'
+        if len(files)>0:
+            if verbose>0: print('Preprocessing data')
+            self._open_store(consolidated=False)
+            for f in progress_bar(files, leave=True if verbose>0 else False):
                 self._preproc_file(f, use_zarr_data=use_zarr_data)
+            zarr.consolidate_metadata(self.preproc_dir)
+            self._open_store()
 
         self.use_zarr_data=use_zarr_data
 
         if self.stats is None:
-            n = len(self.files)
-             #https://stackoverflow.com/questions/60101240/finding-mean-and-standard-deviation-across-image-channels-pytorch/60803379#60803379
-            self.stats = {'channel_means': self.mean_sum/n,
-                          'channel_stds': np.sqrt(self.var_sum/n),
-                          'max_tiles_per_image': self.max_tile_count}
+            attrs = [self.labels[f.name].attrs.asdict() for f in self.files]
+            # Pixel-weighted pooling of the per-image statistics
+            stats = ChannelStats()
+            for a in attrs: stats.merge(ChannelStats(**a['channel_stats']))
+            self.stats = {'channel_means': stats.mean,
+                          'channel_stds': stats.std,
+                          'max_tiles_per_image': max(tiles_in_rectangles(*a['shape'][:2], *self.actual_tile_shape) for a in attrs)}
             print('Calculated stats', self.stats)
 
     def get_data(self, files=None, max_n=None, mask=False):
@@ -419,6 +1049,44 @@ class BaseDataset(Dataset):
             else:
                 show(img, file_name=f.name, figsize=figsize, show_bbox=False, **kwargs)
 
+# Cell
+def _raw_dtype(img):
+    "Keeps the dtype of unnormalized tiles (e.g., uint8) unless torch<2.3 cannot represent it"
+    if img.dtype.kind=='u' and img.dtype!=np.uint8 and not hasattr(torch, 'uint16'): return img.astype(np.int32)
+    return img
+
+# Cell
+def _sample_cdf(cdf, orig_shape, r, reshape=512):
+    "Binary search for uniform random numbers `r` in the (reshaped) CDF and rescale to `orig_shape`"
+    reshape_y = int((orig_shape[1]/orig_shape[0])*reshape)
+    idx = np.searchsorted(cdf, np.asarray(r)*cdf[-1], side='right').clip(max=len(cdf)-1)
+    cx, cy = np.unravel_index(idx, (reshape,reshape_y))
+    return np.stack(((cx*orig_shape[0]/reshape).astype(int), (cy*orig_shape[1]/reshape_y).astype(int)), axis=-1)
+
+def _class_weights(counts, balanced=False):
+    "Sampling weight per class: 1-frequency (as in `_create_cdf`), or the same total probability for each present class if `balanced`"
+    w = np.where(counts>0, 1/np.maximum(counts, 1), 0.) if balanced else 1-counts/max(counts.sum(), 1)
+    # Uniform over pixels if only one class is present
+    return w if (w*counts).sum()>0 else (counts>0).astype(float)
+
+def _sample_weighted(p):
+    "Random index drawn with probability proportional to `p`"
+    c = np.cumsum(p)
+    return min(int(np.searchsorted(c, np.random.random()*c[-1], side='right')), len(c)-1)
+
+def _sample_grid(grid, lbl, balanced=False, ignore=None):
+    "Samples a cell of the class `grid` of `lbl`, then a class within the cell, and finally a pixel of that class"
+    counts = grid.reshape(-1, grid.shape[-1])
+    p = counts*_class_weights(counts.sum(0), balanced)
+    i = _sample_weighted(p.sum(1))
+    k = _sample_weighted(p[i])
+    (y, x), (ch, cw) = divmod(i, grid.shape[1]), _grid_cells(lbl.shape, grid.shape)
+    sl = (slice(y*ch, (y+1)*ch), slice(x*cw, (x+1)*cw))
+    valid = np.asarray(lbl[sl])==k
+    if ignore is not None: valid &= ~np.asarray(ignore[sl], dtype=bool)
+    j = np.random.choice(np.flatnonzero(valid))
+    return (y*ch + j//valid.shape[1], x*cw + j%valid.shape[1])
+
 # Cell
 class RandomTileDataset(BaseDataset):
     """
@@ -426,9 +1094,9 @@ class RandomTileDataset(BaseDataset):
     """
     n_inp = 1
     def __init__(self, *args, sample_mult=None, flip=True, rotation_range_deg=(0, 360), scale_range=(0, 0),
-                 albumentations_tfms=[A.RandomGamma()], min_length=400, **kwargs):
+                 albumentations_tfms=[A.RandomGamma()], min_length=400, num_replicas=1, rank=0, **kwargs):
         super().__init__(*args, **kwargs)
-        store_attr('sample_mult, flip, rotation_range_deg, scale_range, albumentations_tfms')
+        store_attr('sample_mult, flip, rotation_range_deg, scale_range, albumentations_tfms, num_replicas, rank')
 
         # Sample mulutiplier: Number of random samplings from augmented image
         if self.sample_mult is None:
@@ -444,30 +1112,48 @@ class RandomTileDataset(BaseDataset):
                             std=self.stats['channel_stds'],
                             max_pixel_value=1.0)
             ]
-        self.tfms =  A.Compose(tfms+[ToTensorV2()])
+        # Weights undergo the same spatial transforms as the mask
+        self.tfms =  A.Compose(tfms+[ToTensorV2()], additional_targets={'weights':'mask'} if self.weights else None)
+
+    def _get_cdf(self, name):
+        "Returns the CDF of image `name`, held in memory (or the shared cache) after the first access"
+        if self.cache is not None: return self._read_preproc('pdfs', name)
+        if not hasattr(self, '_cdfs'): self._cdfs = {}
+        if name not in self._cdfs: self._cdfs[name] = self.pdfs[name][:]
+        return self._cdfs[name]
+
+    def _get_grid(self, name):
+        "Returns the class grid of image `name`, held in memory after the first access"
+        if not hasattr(self, '_grids'): self._grids = {}
+        if name not in self._grids: self._grids[name] = self.grids[name][:]
+        return self._grids[name]
+
+    def _grid_center(self, name):
+        "Sample random center using the class grid"
+        return _sample_grid(self._get_grid(name), self._read_preproc('labels', name), self.sampling=='balanced', self.ignore.get(name))
 
     def _random_center(self, pdf, orig_shape, reshape=512):
         'Sample random center using PDF'
-        reshape_y = int((orig_shape[1]/orig_shape[0])*reshape)
-        cx, cy = np.unravel_index(np.argmax(pdf > random.random()), (reshape,reshape_y))
-        cx = int(cx*orig_shape[0]/reshape)
-        cy = int(cy*orig_shape[1]/reshape_y)
-        return cx, cy
+        return tuple(_sample_cdf(pdf, orig_shape, random.random(), reshape))
+
+    def sample_centers(self, file, n=1):
+        "Draws `n` random tile centers for `file` using its PDF (or class grid)"
+        if self.sampling!='cdf': return np.array([self._grid_center(file.name) for _ in range(n)])
+        return _sample_cdf(self._get_cdf(file.name), self.labels[file.name].shape, np.random.random(n), self.pdf_reshape)
 
     def __len__(self):
-        return len(self.files)*self.sample_mult
+        # Each of `num_replicas` distributed ranks draws its own share of the samples
+        return -(-len(self.files)*self.sample_mult//self.num_replicas)
 
     def __getitem__(self, idx):
-        idx = idx % len(self.files)
         if torch.is_tensor(idx):
             idx = idx.tolist()
+        idx = (idx*self.num_replicas+self.rank) % len(self.files)
 
         img_path = self.files[idx]
-        img = self.read_img(img_path)
-
-        msk = self.labels[img_path.name]
-        pdf = self.pdfs[img_path.name]
-        center = self._random_center(pdf[:], msk.shape)
+        if self.sampling=='cdf':
+            center = self._random_center(self._get_cdf(img_path.name), self.labels[img_path.name].shape, self.pdf_reshape)
+        else: center = self._grid_center(img_path.name)
 
         deformationField = DeformationField(self.tile_shape, self.scale, self.scale_range)
         if self.flip:
@@ -476,30 +1162,49 @@ class RandomTileDataset(BaseDataset):
         if self.rotation_range_deg[1] > self.rotation_range_deg[0]:
             deformationField.add_random_rotation(self.rotation_range_deg)
 
-        img = deformationField.apply(img, center)
-        msk = deformationField.apply(msk, center)
+        # Read from the closest pyramid level, leaving only a small residual rescaling
+        f = self._pyramid_factor(deformationField.scale)
+        img = deformationField.apply(self.read_level(img_path, f), center, factor=f)
+        msk = deformationField.apply(self.read_level(img_path, f, mask=True), center, factor=f)
+        if not self.normalize: img = _raw_dtype(img)
+
+        if self.weights:
+            wgt = deformationField.apply(self._read_preproc('weight_maps', img_path.name), center)
+            aug = self.tfms(image=img, mask=msk, weights=wgt)
+            return aug['image'], aug['mask'].type(torch.int64), aug['weights'].type(torch.float32)
 
         aug = self.tfms(image=img, mask=msk)
 
         return  aug['image'], aug['mask'].type(torch.int64)
 
+# Cell
+def _tile_plan(data_shape, output_shape, bpf=0.25, max_tile_shift=1.):
+    "Tile centers (n, 2) and (start, stop) bounds (n, 2, 2) of the output and input slices for an image of `data_shape`"
+    start_points = [o//2 - o*bpf for o in output_shape]
+    end_points = [(s - st) for s, st in zip(data_shape, start_points)]
+    n_points = [int((s+2*o*bpf)//(o*max_tile_shift))+1 for s, o in zip(data_shape, output_shape)]
+    cy, cx = [np.linspace(st, e, num=n, endpoint=True, dtype=np.int64) for st, e, n in zip(start_points, end_points, n_points)]
+    # Row-major in x (same order as iterating over x, then y)
+    c = np.stack([np.tile(cy, len(cx)), np.repeat(cx, len(cy))], axis=1)
+    o, s = np.array(output_shape), np.array(data_shape)
+    out_bounds = np.stack([np.clip(c-o/2, 0, s), np.minimum(c+o/2, s)], axis=-1).astype(np.int64)
+    in_bounds = np.stack([np.clip(o/2-c, 0, None), np.minimum(o, s-c+o/2)], axis=-1).astype(np.int64)
+    assert (np.diff(in_bounds, axis=-1)==np.diff(out_bounds, axis=-1)).all(), 'Input/Output slices do not match'
+    return c, out_bounds, in_bounds
+
 # Cell
 class TileDataset(BaseDataset):
     "Pytorch Dataset that creates random tiles for validation and prediction on new data."
     n_inp = 1
-    def __init__(self, *args, val_length=None, val_seed=42, max_tile_shift=1., border_padding_factor=0.25, return_index=False, **kwargs):
+    def __init__(self, *args, val_length=None, val_seed=42, max_tile_shift=1., border_padding_factor=0.25, return_index=False, materialize=False, **kwargs):
         super().__init__(*args, **kwargs)
         self.max_tile_shift = max_tile_shift
         self.bpf = border_padding_factor
         self.return_index = return_index
         self.output_shape = tuple(int(t - p) for (t, p) in zip(self.tile_shape, self.padding))
         self.tiler = DeformationField(self.tile_shape, scale=self.scale)
-        self.image_indices = []
-        self.image_shapes = []
-        self.in_slices = []
-        self.out_slices = []
-        self.centers = []
         self.valid_indices = None
+        self.tile_key = None
 
         tfms = []
         if self.normalize:
@@ -511,62 +1216,76 @@ class TileDataset(BaseDataset):
         self.tfms =  A.Compose(tfms+[ToTensorV2()])
 
 
-        j = 0
-        for i, file in enumerate(progress_bar(self.files, leave=False)):
-            img = self.read_img(file)
-            # Tiling
-            data_shape = tuple(int(x//self.scale) for x in img.shape[:-1])
-            start_points = [o//2 - o*self.bpf for o in self.output_shape]
-            end_points = [(s - st) for s, st in zip(data_shape, start_points)]
-            n_points = [int((s+2*o*self.bpf)//(o*self.max_tile_shift))+1 for s, o in zip(data_shape, self.output_shape)]
-            center_points = [np.linspace(st, e, num=n, endpoint=True, dtype=np.int64) for st, e, n in zip(start_points, end_points, n_points)]
-            for cx in center_points[1]:
-                for cy in center_points[0]:
-                    self.centers.append((int(cy*self.scale), int(cx*self.scale)))
-                    self.image_indices.append(i)
-                    self.image_shapes.append(data_shape)
-
-                    # Calculate output slices for whole image
-                    out_slice = tuple(slice(int((c - o/2).clip(0, s)), int((c + o/2).clip(max=s)))
-                                     for (c, o, s) in zip((cy, cx), self.output_shape, data_shape))
-                    self.out_slices.append(out_slice)
-
-                    # Calculate input slices for tile
-                    in_slice = tuple(slice(int((o/2-c).clip(0)), int(np.float64(o).clip(max=(s-c+o/2)))) for
-                                     (c, o, s) in zip((cy, cx), self.output_shape, data_shape))
-                    self.in_slices.append(in_slice)
-                    #assert img[in_slice].shape == img[out_slice].shape, 'Input/Output slices do not match'
-                    assert (in_slice[0].stop-in_slice[0].start) == (out_slice[0].stop-out_slice[0].start), 'Input/Output slices do not match'
-                    assert (in_slice[1].stop-in_slice[1].start) == (out_slice[1].stop-out_slice[1].start), 'Input/Output slices do not match'
-                    j += 1
+        # Tile plan as arrays: image index, center, and (start, stop) of the output/input slices per tile and dimension
+        shapes = [tuple(int(x//self.scale) for x in self.read_shape(file)) for file in progress_bar(self.files, leave=False)]
+        plans = [_tile_plan(s, self.output_shape, self.bpf, self.max_tile_shift) for s in shapes]
+        self.data_shapes = np.array(shapes, dtype=np.int64)
+        self.image_indices = np.repeat(np.arange(len(plans)), [len(p[0]) for p in plans])
+        centers, self.out_bounds, self.in_bounds = [np.concatenate([p[i] for p in plans]) for i in range(3)]
+        self.centers = (centers*self.scale).astype(np.int64)
 
         if val_length:
-            if val_length>len(self.image_shapes):
-                print(f'Reducing validation from lenght {val_length} to {len(self.image_shapes)}')
-                val_length = len(self.image_shapes)
+            if val_length>len(self.image_indices):
+                print(f'Reducing validation from lenght {val_length} to {len(self.image_indices)}')
+                val_length = len(self.image_indices)
             rs = np.random.RandomState(val_seed)
             choice = rs.choice(len(self.image_indices), val_length, replace=False)
             self.valid_indices = {i:idx for i, idx in  enumerate(choice)}
 
+        if materialize:
+            assert self.label_fn is not None, 'Materializing tiles requires labels'
+            self._materialize()
+
+    def _materialize(self):
+        "Writes all tiles and masks once to the preprocessed store, where they are reused by datasets with the same data and settings"
+        settings = ([self._fingerprint(f) for f in self.files], self.tile_shape, self.padding, self.scale, self.max_tile_shift, self.bpf,
+                    self.pyramid_factors, sorted(self.valid_indices.items()) if self.valid_indices else None,
+                    {k:np.asarray(v).tolist() for k,v in self.stats.items()} if self.normalize else None)
+        key = hashlib.md5(repr(settings).encode()).hexdigest()
+        self.tiles = zarr.open_group(self.preproc_dir, mode='a').require_group('tiles')
+        if not (key in self.tiles and self.tiles[key].attrs.get('complete', False)):
+            # Written under a private name and moved when complete, concurrent processes (e.g., parallel folds or trials) never read partial tiles
+            tmp = f'{key}.{os.getpid()}-{secrets.token_hex(4)}'
+            g = self.tiles.create_group(tmp, overwrite=True)
+            img, msk = self[0]
+            zarr_kwargs = {'compressor':_compressor_dict[self.compressor], 'overwrite':True}
+            imgs = g.empty('images', shape=(len(self),)+tuple(img.shape), chunks=(1,)+tuple(img.shape), dtype=img.numpy().dtype, **zarr_kwargs)
+            msks = g.empty('masks', shape=(len(self),)+msk.shape, chunks=(1,)+msk.shape, dtype='uint8', filters=[MaskCodec()], **zarr_kwargs)
+            for i in progress_bar(range(len(self)), leave=False):
+                img, msk = self[i]
+                imgs[i], msks[i] = img.numpy(), msk
+            g.attrs['complete'] = True
+            if key in self.tiles and not self.tiles[key].attrs.get('complete', False): del self.tiles[key]
+            try: self.tiles.move(tmp, key)
+            # Another process materialized the same tiles first
+            except (ValueError, OSError): del self.tiles[tmp]
+        if self.backend=='shared_memory': self.tiles = SharedMemoryDataset(self.tiles, [f'{key}/images', f'{key}/masks'])
+        self.tile_key = key
+
     def __len__(self):
         if self.valid_indices: return len(self.valid_indices)
-        else: return len(self.image_shapes)
+        else: return len(self.image_indices)
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
+        if self.tile_key is not None:
+            img, msk = (self._read_preproc('tiles', f'{self.tile_key}/{n}')[idx] for n in ('images', 'masks'))
+            return torch.from_numpy(np.array(img)), msk.astype('int64')
         if self.valid_indices: idx = self.valid_indices[idx]
         img_path = self.files[self.image_indices[idx]]
         #img = self.data[img_path.name]
-        img = self.read_img(img_path)
+        f = self._pyramid_factor(self.scale)
+        img = self.read_level(img_path, f)
         centerPos = self.centers[idx]
 
-        img = self.tiler.apply(img, centerPos)
+        img = self.tiler.apply(img, centerPos, factor=f)
+        if not self.normalize: img = _raw_dtype(img)
         aug = self.tfms(image=img)
 
         if self.label_fn is not None:
-            msk = self.labels[img_path.name]
-            msk = self.tiler.apply(msk, centerPos).astype('int64')
+            msk = self.read_level(img_path, f, mask=True)
+            msk = self.tiler.apply(msk, centerPos, factor=f).astype('int64')
             return  aug['image'], msk
 
         else:
@@ -579,9 +1298,9 @@ class TileDataset(BaseDataset):
         'Returns dict containing information for image reconstruction'
 
         return {
-            'out_idx' : self.image_indices[idx],
+            'out_idx' : int(self.image_indices[idx]),
             'out_name' : self.files[self.image_indices[idx]].name,
-            'out_shape' : self.image_shapes[idx],
-            'out_slice' : self.out_slices[idx],
-            'in_slice' : self.in_slices[idx]
+            'out_shape' : tuple(int(x) for x in self.data_shapes[self.image_indices[idx]]),
+            'out_slice' : tuple(slice(*b) for b in self.out_bounds[idx].tolist()),
+            'in_slice' : tuple(slice(*b) for b in self.in_bounds[idx].tolist())
         }
\ No newline at end of file
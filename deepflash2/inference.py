@@ -155,6 +155,7 @@ class InferenceEnsemble(torch.nn.Module):
                  border_padding_factor:float = 0.25,
                  max_tile_shift:float = 0.9,
                  scale:float = 1.,
+                 use_pyramid:bool = False,
                  device:str='cpu'):
 
         super().__init__()
@@ -168,8 +169,12 @@ class InferenceEnsemble(torch.nn.Module):
         dummy_input = torch.rand(1, in_channels, *self.tile_shape).to(device)
         self.models = torch.nn.ModuleList([torch.jit.trace(m.to(device).eval(), dummy_input) for m in models])
 
+        # For scale>=2, downsample the image once to the closest power-of-2 level and tile with the residual scale
+        self.pyramid_factor = 1
+        while use_pyramid and self.pyramid_factor*2<=scale: self.pyramid_factor *= 2
+
         self.tiler = torch.jit.script(TileModule(tile_shape=tile_shape,
-                                                 scale=scale,
+                                                 scale=scale/self.pyramid_factor,
                                                  border_padding_factor=border_padding_factor,
                                                  max_tile_shift=max_tile_shift))
 
@@ -183,8 +188,11 @@ class InferenceEnsemble(torch.nn.Module):
 
         # Extract image shape (assuming HWC)
         sh = x.shape[:-1]
+        if self.pyramid_factor>1:
+            x = F.avg_pool2d(x.permute(2,0,1).unsqueeze(0), self.pyramid_factor)[0].permute(1,2,0)
+        sh_level = x.shape[:-1]
         # Workaround for sh_scaled = [int(s/self.tiler.scale) for s in img_shape]
-        sh_scaled = (torch.tensor(sh)/self.tiler.scale).to(torch.int64)
+        sh_scaled = (torch.tensor(sh_level)/self.tiler.scale).to(torch.int64)
         sh_scaled = [int(t.item()) for t in sh_scaled]
 
         # Create zero arrays (only on CPU RAM to avoid GPU memory overflow on large images)
@@ -194,7 +202,7 @@ class InferenceEnsemble(torch.nn.Module):
         stdeviation = torch.zeros((sh_scaled[0], sh_scaled[1]), dtype=torch.float32, device=x.device)
 
         # Get slices for tiling
-        in_slices, out_slices, center_points = self.tiler.get_slices_and_centers(sh)
+        in_slices, out_slices, center_points = self.tiler.get_slices_and_centers(sh_level)
 
         #
         self.mw.to(x)
@@ -239,7 +247,7 @@ class InferenceEnsemble(torch.nn.Module):
         stdeviation /= merge_map
 
         # Rescale results
-        if self.tiler.scale!=1.:
+        if self.tiler.scale!=1. or self.pyramid_factor>1:
             # Needs checking if these are the best options
             softmax = F.interpolate(softmax.unsqueeze_(0), size=sh, mode="bilinear", align_corners=False)[0]
             stdeviation = stdeviation.view(1, 1, stdeviation.shape[0], stdeviation.shape[1])
@@ -1,39 +1,51 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/03_learner.ipynb (unless otherwise specified).
 
-__all__ = ['EnsembleBase', 'EnsembleLearner', 'EnsemblePredictor']
+__all__ = ['WeightMapCallback', 'DeviceNormalizeCallback', 'DistributedCallback', 'TileCurriculumCallback', 'StepBudgetCallback', 'ThroughputCallback', 'CheckpointCallback', 'EnsembleBase', 'EnsembleLearner', 'HyperparameterSearch', 'EnsemblePredictor']
 
 # Cell
+import os
+import hashlib
 import torch
+import torch.distributed as dist
 import time
+import queue
+import random
+import threading
+import traceback
+import multiprocessing as mp
 import zarr
 import pandas as pd
 import numpy as np
 import cv2
 import tifffile
 from pathlib import Path
+from dataclasses import asdict
 from typing import List, Union, Tuple
+from torch.nn.parallel import DistributedDataParallel
+from torchvision.transforms import Normalize
 
 from skimage.color import label2rgb
 from sklearn.model_selection import KFold
 
 from fastprogress import progress_bar
-from fastcore.basics import GetAttr
+from fastcore.basics import GetAttr, noop, store_attr
 from fastcore.foundation import L
 from fastai import optimizer
-from fastai.learner import Learner
+from fastai.torch_core import set_seed, get_model, find_bs
+from fastai.learner import Learner, Recorder
 from fastai.callback.all import *
-from fastai.callback.tracker import SaveModelCallback
+from fastai.callback.tracker import SaveModelCallback, TrackerCallback
 from fastai.callback.progress import CSVLogger
 from fastai.data.core import DataLoaders
 from fastai.data.transforms import get_image_files, get_files
 
 from .config import Config
-from .data import BaseDataset, TileDataset, RandomTileDataset
+from .data import BaseDataset, TileDataset, RandomTileDataset, SharedArrayCache
 from .models import create_smp_model, save_smp_model, load_smp_model, run_cellpose
 from .inference import InferenceEnsemble
 from .losses import get_loss
 from .utils import compose_albumentations as _compose_albumentations
-from .utils import dice_score, binary_dice_score, plot_results, get_label_fn, save_mask, save_unc, export_roi_set, get_instance_segmentation_metrics
+from .utils import calc_iterations, dice_score, binary_dice_score, fast_confusion_matrices, segmentation_scores, plot_results, get_label_fn, save_mask, save_unc, export_roi_set, get_instance_segmentation_metrics
 from fastai.metrics import Dice, DiceMulti
 
 import matplotlib.pyplot as plt
@@ -55,6 +67,226 @@ _optim_dict = {
     'RMSProp' : optimizer.RMSProp,
 }
 
+# Cell
+class WeightMapCallback(Callback):
+    "Passes the weights of `RandomTileDataset(weights=True)` only to the loss function, metrics receive the mask"
+    def after_loss(self):
+        if len(self.yb)>1: self.learn.yb = self.yb[:1]
+
+class DeviceNormalizeCallback(Callback):
+    "Normalizes raw (e.g., uint8) image batches with `mean` and `std` on the training device"
+    def __init__(self, mean, std): self.norm = Normalize(list(mean), list(std))
+    def before_batch(self): self.learn.xb = (self.norm(self.xb[0].float()),)+self.xb[1:]
+
+class DistributedCallback(Callback):
+    "Wraps the model in `DistributedDataParallel` to all-reduce the gradients across the ranks of the default process group"
+    def before_fit(self):
+        device = next(self.model.parameters()).device
+        self.learn.model = DistributedDataParallel(self.model, device_ids=[device] if device.type=='cuda' else None)
+    def after_fit(self): self.learn.model = self.model.module
+
+class _StopAfterCallback(Callback):
+    "Stops training after `n_iter` iterations"
+    # After the bookkeeping of the other callbacks
+    order = Recorder.order+10
+    def __init__(self, n_iter): self.n_iter_max = n_iter
+    def after_batch(self):
+        if self.training and self.train_iter>=self.n_iter_max: raise CancelFitException
+
+class TileCurriculumCallback(Callback):
+    "Grows the training tiles from `min_size` to the dataset `tile_shape` over the first `pct` of the epochs, batch sizes keep the pixels per batch"
+    def __init__(self, min_size=256, pct=0.5, multiple=32): store_attr()
+    def before_fit(self):
+        self._ds = self.dls.train.dataset
+        self._tile_shape, self._bs = self._ds.tile_shape, self.dls.train.bs
+
+    def before_train(self):
+        p = min(1., self.epoch/(self.pct*self.n_epoch)) if self.pct>0 else 1.
+        # Sizes divisible by `multiple` fit the downsampling of the encoders
+        shape = tuple(int(min(t, max(self.multiple, (self.min_size+p*(t-self.min_size))//self.multiple*self.multiple))) for t in self._tile_shape)
+        self._ds.tile_shape = shape
+        self.dls.train.bs = max(1, int(self._bs*np.prod(self._tile_shape)/np.prod(shape)))
+
+    def after_fit(self): self._ds.tile_shape, self.dls.train.bs = self._tile_shape, self._bs
+
+def _batches_per_step(bs, effective_batch_size=0):
+    "Batches of size `bs` per optimizer step with `GradientAccumulation(effective_batch_size)`"
+    return -(-effective_batch_size//bs) if effective_batch_size>bs else 1
+
+class StepBudgetCallback(Callback):
+    "Sets the training length of each epoch to `steps` optimizer steps, recomputed after batch size changes (e.g., by `TileCurriculumCallback`)"
+    order = TileCurriculumCallback.order+1
+    def __init__(self, steps, effective_batch_size=0): store_attr()
+    def before_train(self):
+        bs = self.dls.train.bs
+        # Indices wrap around the files, the length can exceed the dataset
+        self.dls.train.n = self.steps*_batches_per_step(bs, self.effective_batch_size)*bs
+
+class ThroughputCallback(Callback):
+    "Logs the training samples/s, the fraction of time waiting for data and the mean step time (ms) of this process with the metrics, warns above `max_wait`"
+    order = Recorder.order+5
+    names = ['samples/s', 'data_wait', 'step_ms']
+    def __init__(self, max_wait=0.3): self.max_wait = max_wait
+    def before_fit(self):
+        self._warned = False
+        # Inserted before the time column, `CSVLogger` and `ProgressCallback` write the names afterwards
+        names = self.recorder.metric_names
+        i = len(names)-int(self.recorder.add_time)
+        self.recorder.metric_names = names[:i]+self.names+names[i:]
+
+    def before_train(self):
+        self._cuda = next(get_model(self.model).parameters()).is_cuda
+        self.n_samples, self.n_steps, self.wait, self.step = 0, 0, 0., 0.
+        self.start = self._t = time.perf_counter()
+
+    def before_batch(self):
+        if not self.training: return
+        t = time.perf_counter()
+        self.wait, self._t = self.wait+t-self._t, t
+
+    def after_batch(self):
+        if not self.training: return
+        # Batches cancelled before this callback (e.g., replayed by `CheckpointCallback`) are not counted
+        if len(self.yb)>0:
+            # Kernels run asynchronously, their time belongs to the step
+            if self._cuda: torch.cuda.synchronize()
+            self.n_samples, self.n_steps = self.n_samples+find_bs(self.xb), self.n_steps+1
+            self.step += time.perf_counter()-self._t
+        self._t = time.perf_counter()
+
+    def summary(self):
+        "Samples/s, data wait fraction and step time (ms) of the training iterations so far"
+        elapsed = time.perf_counter()-self.start
+        return [self.n_samples/elapsed, self.wait/elapsed, 1000*self.step/max(1, self.n_steps)]
+
+    def after_train(self):
+        self.values = self.summary()
+        if self.max_wait and self.values[1]>self.max_wait and not self._warned:
+            warnings.warn(f'Training waited {self.values[1]:.0%} of the time for data, see `EnsembleLearner.tune_dataloader`')
+            self._warned = True
+
+    def after_validate(self): self.recorder.log += self.values
+
+# Cell
+def _cpu_copy(o):
+    "Copy of `o` with tensors moved to the CPU and containers converted to builtins (readable with `torch.load(weights_only=True)`)"
+    if torch.is_tensor(o): return o.detach().to('cpu', copy=True)
+    if isinstance(o, np.generic): return o.item()
+    if isinstance(o, dict): return {k:_cpu_copy(v) for k,v in o.items()}
+    if isinstance(o, (list, tuple, L)): return (tuple if isinstance(o, tuple) else list)(_cpu_copy(v) for v in o)
+    return o
+
+def _get_rng_state():
+    "States of the python, numpy and torch random number generators"
+    np_state = np.random.get_state()
+    return {'random':random.getstate(), 'numpy':(np_state[0], torch.from_numpy(np_state[1].astype('int64')), *np_state[2:]),
+            'torch':torch.get_rng_state(), 'cuda':torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+def _set_rng_state(state):
+    "Restores the random number generators from `_get_rng_state`"
+    random.setstate(state['random'])
+    np_state = state['numpy']
+    np.random.set_state((np_state[0], np_state[1].cpu().numpy().astype('uint32'), *np_state[2:]))
+    torch.set_rng_state(state['torch'].cpu())
+    if state['cuda'] and torch.cuda.is_available(): torch.cuda.set_rng_state_all([o.cpu() for o in state['cuda']])
+
+def _write_checkpoint(state, fname):
+    "Atomically writes `state` to `fname`, an interrupted write keeps the previous checkpoint"
+    tmp = fname.with_suffix('.part')
+    torch.save(state, tmp)
+    os.replace(tmp, fname)
+
+class CheckpointCallback(Callback):
+    "Writes resumable checkpoints to `fname` in the background every `every` training iterations and at the start of each epoch, resumes from `state`"
+    order = TrainEvalCallback.order+1
+    def __init__(self, fname, every=500, state=None, write=True, restore_rng=True):
+        store_attr('every, state, write, restore_rng')
+        self.fname, self.fit_no, self._thread, self._paused, self._rng, self._skip = Path(fname), 0, None, [], None, 0
+
+    @property
+    def _trackers(self): return self.cbs.filter(lambda cb: isinstance(cb, TrackerCallback))
+
+    def _pause(self, cbs):
+        for cb in cbs: cb.run = False
+        self._paused += list(cbs)
+
+    def _resume_paused(self):
+        for cb in self._paused: cb.run = True
+        self._paused = []
+
+    def _rng_state(self):
+        "Random number generator states, including the shuffling generator of the train `DataLoader`"
+        return {**_get_rng_state(), 'dl':self.dls.train.rng.getstate()}
+
+    def _checkpoint(self, iter=0, rng=None):
+        if not self.write: return
+        scaler = getattr(self.learn, 'scaler', None)
+        state = {'fit':self.fit_no, 'n_epoch':self.n_epoch, 'epoch':self.epoch, 'iter':iter, 'train_iter':self.train_iter-iter,
+                 'model':get_model(self.model).state_dict(), 'opt':self.opt.state_dict(),
+                 'scaler':scaler.state_dict() if scaler is not None else None,
+                 'recorder':{k:getattr(self.recorder, k) for k in ('lrs', 'losses', 'iters', 'values')},
+                 'best':[cb.best for cb in self._trackers], 'rng':rng or self._rng_state()}
+        # Copy synchronously, the next optimizer step changes the tensors in place
+        state = _cpu_copy(state)
+        if self._thread is not None: self._thread.join()
+        self.fname.parent.mkdir(exist_ok=True, parents=True)
+        self._thread = threading.Thread(target=_write_checkpoint, args=(state, self.fname))
+        self._thread.start()
+
+    def before_fit(self):
+        self.fit_no += 1
+        self._resume_paused()
+        s = self.state
+        if s is None or self.fit_no!=s['fit']: return
+        assert s['n_epoch']==self.n_epoch, f"Checkpoint was trained for {s['n_epoch']} epochs, not {self.n_epoch}"
+        get_model(self.model).load_state_dict(s['model'])
+        self.opt.load_state_dict({'state':s['opt']['state'], 'hypers':L(s['opt']['hypers'])})
+
+    def before_epoch(self):
+        self._resume_paused()
+        s = self.state
+        if s is None:
+            if self.fit_no>1 or self.epoch>0: self._checkpoint()
+            return
+        if self.fit_no<s['fit']:
+            # Skip finished fits (e.g., the frozen epoch of `fine_tune`)
+            self._pause(self._trackers+[self.recorder])
+            raise CancelEpochException
+        if self.epoch<s['epoch']:
+            # Skip finished epochs, the recorder replays their logs and trackers are paused
+            self.recorder.log, self.recorder.start_epoch = L(self.epoch)+s['recorder']['values'][self.epoch], time.time()
+            self._pause(self._trackers)
+            raise CancelEpochException
+        for k in ('lrs', 'losses', 'iters'): setattr(self.recorder, k, list(s['recorder'][k]))
+        for cb, best in zip(self._trackers, s['best']): cb.best = best
+        if s['scaler'] is not None and getattr(self.learn, 'scaler', None) is not None: self.learn.scaler.load_state_dict(s['scaler'])
+        # Skipped batches count again, as in the interrupted run
+        self.learn.train_iter = s['train_iter']
+        self._rng, self._skip, self.state = s['rng'] if self.restore_rng else None, s['iter'], None
+
+    def before_train(self):
+        # Before `DataLoader.__iter__`, the restored shuffling generator yields the data order of the interrupted epoch
+        if self._rng is not None:
+            _set_rng_state(self._rng)
+            self.dls.train.rng.setstate(self._rng['dl'])
+        self._rng, self._epoch_rng = None, self._rng_state()
+
+    def before_batch(self):
+        if self.training and self.iter<self._skip:
+            # Replay the data order up to the checkpoint without computing the batch, the recorder ignores it
+            self.learn.yb = ()
+            raise CancelBatchException
+
+    def after_batch(self):
+        if not self.training: return
+        if self.every and self.iter>=self._skip and (self.iter+1)%self.every==0 and self.iter+1<self.n_iter:
+            self._checkpoint(self.iter+1, self._epoch_rng)
+
+    def after_train(self): self._skip = 0
+
+    def after_fit(self):
+        if self._thread is not None: self._thread.join()
+
 # Cell
 class EnsembleBase(GetAttr):
     _default = 'config'
@@ -102,6 +334,8 @@ class EnsembleBase(GetAttr):
 
     def predict(self, arr:Union[np.ndarray, torch.Tensor]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         'Get prediction for arr using inference_ensemble'
+        # Lazily read images (zarr, tiled TIFF) are loaded here
+        if not torch.is_tensor(arr): arr = np.asarray(arr)
         inp = torch.tensor(arr).float().to(self.device)
         with torch.inference_mode():
             preds = self.inference_ensemble(inp)
@@ -121,7 +355,7 @@ class EnsembleBase(GetAttr):
 class EnsembleLearner(EnsembleBase):
     "Meta class to training model ensembles with `n` models"
     def __init__(self, *args, ensemble_path=None, preproc_dir=None, metrics=None, cbs=None,
-                 ds_kwargs={}, dl_kwargs={}, model_kwargs={}, stats=None, **kwargs):
+                 ds_kwargs={}, dl_kwargs={}, model_kwargs={}, stats=None, cache=None, shared_arrays=None, **kwargs):
         super().__init__(*args, **kwargs)
 
         assert hasattr(self, 'label_fn'), 'mask_dir or label_fn must be provided.'
@@ -131,6 +365,7 @@ class EnsembleLearner(EnsembleBase):
         self.add_ds_kwargs = ds_kwargs
         default_metrics = [Dice()] if self.num_classes==2 else [DiceMulti()]
         self.metrics = metrics or default_metrics
+        assert not self.border_weights or self.loss=='WeightedCrossEntropyLoss', 'Border weights require WeightedCrossEntropyLoss'
         self.loss_fn = self.get_loss()
         self.cbs = cbs or [SaveModelCallback(monitor='dice' if self.num_classes==2 else 'dice_multi')] #ShowGraphCallback
         self.ensemble_dir = ensemble_path or self.path/self.ens_dir
@@ -141,12 +376,36 @@ class EnsembleLearner(EnsembleBase):
 
         self.n_splits=min(len(self.files), self.max_splits)
         self._set_splits()
-        self._create_ds(stats=self.stats, preproc_dir=preproc_dir, verbose=1, **self.add_ds_kwargs)
+        ds_kwargs = {'preproc_dir': preproc_dir or self.path/self.config.preproc_dir, **self._preproc_ds_kwargs()}
+        # With torchrun, rank 0 preprocesses the shared store while the other ranks wait to open it read-only
+        rank, world_size = _init_distributed(self.dist_backend) if self.distributed else (0, 1)
+        if rank>0: dist.barrier()
+        self._create_ds(stats=self.stats, verbose=1 if rank==0 else 0, read_only=rank>0, **{**ds_kwargs, **self.add_ds_kwargs})
+        if rank==0 and world_size>1: dist.barrier()
+        # Ignore maps are stored once, the datasets of all folds and processes read them from the store
+        if self.add_ds_kwargs.get('ignore'): self.add_ds_kwargs = {**self.add_ds_kwargs, 'ignore':self.ds.ignore}
+        # RAM cache of decompressed arrays, shared by all train and validation datasets, their workers and spawned processes (`cache`)
+        if cache is None and self.cache_size_gb>0: cache = SharedArrayCache(self.cache_size_gb*2**30)
+        self.cache = cache
+        # Preprocessed arrays in shared memory, loaded once for all folds and spawned processes (`shared_arrays`)
+        if self.data_backend=='shared_memory': self.ds._to_shared_memory(shared_arrays)
         self.stats = self.ds.stats
         self.in_channels = self.ds.get_data(max_n=1)[0].shape[-1]
         self.df_val, self.df_ens, self.df_model, self.ood = None,None,None,None
         self.recorder = {}
 
+    def _preproc_ds_kwargs(self, config=None):
+        "Arguments of the dataset that preprocesses the data with the settings of `config` (default: of this learner)"
+        c = config or self.config
+        return {'use_preprocessed_labels': True,
+                'compressor': c.preproc_compressor,
+                'tile_shape': (c.tile_shape,)*2,
+                'scale': c.scale,
+                'sampling': c.sampling,
+                'pyramid': c.use_pyramid,
+                'weights': c.border_weights,
+                'weight_kwargs': c.weight_kwargs}
+
     def _set_splits(self):
         if self.n_splits>1:
             kf = KFold(self.n_splits, shuffle=True, random_state=self.random_state)
@@ -163,9 +422,17 @@ class EnsembleLearner(EnsembleBase):
         ds_kwargs = self.add_ds_kwargs.copy()
         ds_kwargs['use_preprocessed_labels']= True
         ds_kwargs['preproc_dir']=self.ds.preproc_dir
+        ds_kwargs['compressor']= self.preproc_compressor
+        ds_kwargs['cache']= self.cache
+        ds_kwargs['backend']= self.data_backend
+        ds_kwargs['shared_arrays']= self.ds.shared_arrays
+        ds_kwargs['pyramid']= self.use_pyramid
+        ds_kwargs['weights']= self.border_weights
+        ds_kwargs['weight_kwargs']= self.weight_kwargs
         ds_kwargs['instance_labels']= self.instance_labels
         ds_kwargs['tile_shape']= (self.tile_shape,)*2
         ds_kwargs['num_classes']= self.num_classes
+        ds_kwargs['sampling']= self.sampling
         ds_kwargs['max_tile_shift']= self.max_tile_shift
         ds_kwargs['scale']= self.scale
         ds_kwargs['border_padding_factor']= self.border_padding_factor
@@ -178,12 +445,21 @@ class EnsembleLearner(EnsembleBase):
         # Settings from config
         ds_kwargs['use_preprocessed_labels']= True
         ds_kwargs['preproc_dir']=self.ds.preproc_dir
+        ds_kwargs['compressor']= self.preproc_compressor
+        ds_kwargs['cache']= self.cache
+        ds_kwargs['backend']= self.data_backend
+        ds_kwargs['shared_arrays']= self.ds.shared_arrays
+        ds_kwargs['pyramid']= self.use_pyramid
+        ds_kwargs['weights']= self.border_weights
+        ds_kwargs['weight_kwargs']= self.weight_kwargs
         ds_kwargs['instance_labels']= self.instance_labels
         ds_kwargs['stats']= self.stats
         ds_kwargs['tile_shape']= (self.tile_shape,)*2
         ds_kwargs['num_classes']= self.num_classes
         ds_kwargs['scale']= self.scale
         ds_kwargs['flip'] = self.flip
+        ds_kwargs['sampling'] = self.sampling
+        ds_kwargs['normalize'] = not self.device_normalization
         ds_kwargs['max_tile_shift']= 1.
         ds_kwargs['border_padding_factor']= 0.
         ds_kwargs['scale']= self.scale
@@ -196,6 +472,13 @@ class EnsembleLearner(EnsembleBase):
         encoder_name = self.encoder_name.replace('_', '-')
         return f'{self.arch}_{encoder_name}_{self.num_classes}classes'
 
+    @property
+    def _extra_cbs(self):
+        cbs = [WeightMapCallback()] if self.border_weights else []
+        if self.device_normalization: cbs.append(DeviceNormalizeCallback(self.stats['channel_means'], self.stats['channel_stds']))
+        if self.effective_batch_size>self.batch_size: cbs.append(GradientAccumulation(self.effective_batch_size))
+        return cbs
+
     def get_loss(self):
         kwargs = {'mode':self.mode,
                   'classes':[x for x in range(1, self.num_classes)],
@@ -206,52 +489,92 @@ class EnsembleLearner(EnsembleBase):
         return get_loss(self.loss, **kwargs)
 
 
-    def _get_dls(self, files, files_val=None):
+    def _get_dls(self, files, files_val=None, num_replicas=1, rank=0):
         ds = []
-        ds.append(RandomTileDataset(files, label_fn=self.label_fn, **self.train_ds_kwargs, verbose=0))
+        ds.append(RandomTileDataset(files, label_fn=self.label_fn, **self.train_ds_kwargs, num_replicas=num_replicas, rank=rank, verbose=0))
         if files_val:
-            ds.append(TileDataset(files_val, label_fn=self.label_fn, **self.train_ds_kwargs, verbose=0))
+            ds.append(TileDataset(files_val, label_fn=self.label_fn, **self.train_ds_kwargs, materialize=self.materialize_val_tiles, verbose=0))
         else:
             ds.append(ds[0])
-        dls = DataLoaders.from_dsets(*ds, bs=self.batch_size, pin_memory=True, **self.dl_kwargs).to(self.device)
+        dl_kwargs = dict(self.dl_kwargs)
+        prefetch_factor = dl_kwargs.pop('prefetch_factor', None)
+        dls = DataLoaders.from_dsets(*ds, bs=self.batch_size, pin_memory=True, **dl_kwargs).to(self.device)
+        # fastai loaders pass the batches per worker from `fake_l` to the pytorch workers
+        if prefetch_factor:
+            for dl in dls.loaders: dl.fake_l.prefetch_factor = prefetch_factor
         return dls
 
+    def _set_iterations(self, dls, n_iterations):
+        "Sets the training length of `dls` for `n_iterations` optimizer steps of `fine_tune`, returns the number of (unfrozen) epochs and the steps per epoch"
+        ds, bs = dls.train.dataset, dls.train.bs
+        n_batches = n_iterations*_batches_per_step(bs, self.effective_batch_size)
+        # Epochs of about the default length, including the frozen epoch
+        n_epochs = max(2, calc_iterations(n_batches, len(ds), bs))
+        steps = -(-n_iterations//n_epochs)
+        ds.sample_mult = max(1, int(np.ceil(steps*_batches_per_step(bs, self.effective_batch_size)*bs*ds.num_replicas/len(ds.files))))
+        dls.train.n = len(ds)
+        return n_epochs-1, steps
+
     def _create_model(self):
         model = create_smp_model(arch=self.arch,
                                  encoder_name=self.encoder_name,
                                  encoder_weights=self.encoder_weights,
                                  in_channels=self.in_channels,
                                  classes=self.num_classes,
+                                 activation_checkpointing=self.activation_checkpointing,
                                  **self.model_kwargs).to(self.device)
         return model
 
 
-    def fit(self, i, n_epochs=None, base_lr=None, **kwargs):
-        'Fit model number `i`'
-        n_epochs = n_epochs or self.n_epochs
+    def _model_path(self, i): return self.ensemble_dir/'single_models'/f'{self.model_name}-fold{i}.pth'
+    def _checkpoint_path(self, i): return self.ensemble_dir/'checkpoints'/f'{self.model_name}-fold{i}.ckpt'
+
+    def fit(self, i, n_epochs=None, base_lr=None, resume=False, **kwargs):
+        'Fit model number `i` for `n_epochs` or `n_iterations` (config), `resume` from the last checkpoint of an interrupted run'
         base_lr = base_lr or self.base_lr
-        name = self.ensemble_dir/'single_models'/f'{self.model_name}-fold{i}.pth'
+        rank, world_size = _init_distributed(self.dist_backend) if self.distributed else (0, 1)
+        if world_size>1 and str(self.device).startswith('cuda'): self.config.set_device(f'cuda:{os.environ.get("LOCAL_RANK", 0)}')
+        name, ckpt = self._model_path(i), self._checkpoint_path(i)
+        state = torch.load(ckpt, map_location=self.device) if resume and ckpt.exists() else None
         model = self._create_model()
+        # Different augmentations on each rank, DistributedDataParallel broadcasts the weights of rank 0
+        if world_size>1: set_seed(self.random_state+rank)
         files_train, files_val = self.splits[i]
-        dls = self._get_dls(files_train, files_val)
+        dls = self._get_dls(files_train, files_val, num_replicas=world_size, rank=rank)
+        steps = None
+        if n_epochs is None and self.n_iterations>0: n_epochs, steps = self._set_iterations(dls, self.n_iterations)
+        n_epochs = n_epochs or self.n_epochs
         log_name = f'{name.name}_{time.strftime("%Y%m%d-%H%M%S")}.csv'
         log_dir = self.ensemble_dir/'logs'
         log_dir.mkdir(exist_ok=True, parents=True)
-        cbs = self.cbs + [CSVLogger(fname=log_dir/log_name)]
+        # Only rank 0 writes logs and checkpoints
+        if rank==0: cbs = self.cbs + [CSVLogger(fname=log_dir/log_name)] + self._extra_cbs
+        else: cbs = [cb for cb in self.cbs if not isinstance(cb, SaveModelCallback)] + self._extra_cbs
+        cbs.append(ThroughputCallback())
+        if world_size>1: cbs.append(DistributedCallback())
+        if self.tile_curriculum_min>0: cbs.append(TileCurriculumCallback(self.tile_curriculum_min, self.tile_curriculum_pct))
+        if steps is not None: cbs.append(StepBudgetCallback(steps, self.effective_batch_size))
+        cbs.append(CheckpointCallback(ckpt, every=self.checkpoint_iters, state=state, write=rank==0, restore_rng=world_size==1))
         self.learn = Learner(dls, model,
                              metrics=self.metrics,
                              wd=self.weight_decay,
                              loss_func=self.loss_fn,
                              opt_func=_optim_dict[self.optim],
                              cbs=cbs)
-        self.learn.model_dir = self.ensemble_dir.parent/'.tmp'
+        # Best model of this fold, kept for resuming (per ensemble, trials of `HyperparameterSearch` train concurrently)
+        self.learn.model_dir = self.ensemble_dir/'.tmp'/name.stem
+        if rank>0: self.learn.remove_cb(ProgressCallback); self.learn.logger = noop
         if self.mixed_precision_training: self.learn.to_fp16()
-        print(f'Starting training for {name.name}')
+        if rank==0: print(f'Starting training for {name.name}' + (f' on {world_size} ranks' if world_size>1 else '') + f' ({n_epochs} epochs, {len(dls.train)} iterations each)')
+        if rank==0 and state is not None: print(f"Resuming from epoch {state['epoch']}, iteration {state['iter']} of fit {state['fit']}")
         self.learn.fine_tune(n_epochs, base_lr=base_lr)
 
-        print(f'Saving model at {name}')
-        name.parent.mkdir(exist_ok=True, parents=True)
-        save_smp_model(self.learn.model, self.arch, name, stats=self.stats)
+        if rank==0:
+            print(f'Saving model at {name}')
+            name.parent.mkdir(exist_ok=True, parents=True)
+            save_smp_model(self.learn.model, self.arch, name, stats=self.stats)
+            if ckpt.exists(): ckpt.unlink()
+        if world_size>1: dist.barrier()
         self.models[i]=name
         self.recorder[i]=self.learn.recorder
 
@@ -278,13 +601,66 @@ class EnsembleLearner(EnsembleBase):
         print(f'Saving model at {ensemble_name}')
         ensemble.save(ensemble_name)
 
-    def fit_ensemble(self, n_epochs=None, skip=False, save_inference_ensemble=True, **kwargs):
-        'Fit `i` models and `skip` existing'
-        for i in range(1, self.n_models+1):
-            if skip and (i in self.models): continue
-            self.fit(i, n_epochs,  **kwargs)
+    def fit_ensemble(self, n_epochs=None, skip=False, save_inference_ensemble=True, n_parallel=None, resume=False, **kwargs):
+        'Fit `i` models and `skip` existing, `n_parallel` models at once in separate processes, `resume` interrupted runs'
+        n_parallel = n_parallel or self.n_parallel
+        if resume:
+            # Saved models without a checkpoint finished before the interruption
+            for i in range(1, self.n_models+1):
+                if self._model_path(i).exists() and not self._checkpoint_path(i).exists(): self.models[i] = self._model_path(i)
+            skip, kwargs = True, {**kwargs, 'resume':True}
+        folds = [i for i in range(1, self.n_models+1) if not (skip and (i in self.models))]
+        if n_parallel>1 and len(folds)>1 and not self.distributed: self._fit_parallel(folds, min(n_parallel, len(folds)), n_epochs, **kwargs)
+        else:
+            for i in folds: self.fit(i, n_epochs,  **kwargs)
         if save_inference_ensemble: self.save_inference_ensemble()
 
+    def _fit_parallel(self, folds, n_parallel, n_epochs=None, **kwargs):
+        "Fit `folds` in `n_parallel` spawned processes"
+        jobs = {i:{'fold':i, 'n_epochs':n_epochs, 'fit_kwargs':kwargs} for i in folds}
+        for i, out in self._run_parallel(jobs, n_parallel):
+            self.models[i], self.recorder[i] = out['name'], _load_recorder(out['recorder'])
+        self.models = dict(sorted(self.models.items()))
+
+    def _el_kwargs(self):
+        "Arguments to recreate this learner in another process"
+        # Callbacks keep a reference to the last learner
+        for cb in self.cbs: cb.learn = None
+        return {'files':self.files, 'label_fn':{f:self.label_fn(f) for f in self.files}.__getitem__,
+                'config':self.config, 'path':self.path, 'preproc_dir':self.ds.preproc_dir,
+                'metrics':self.metrics, 'cbs':self.cbs, 'ds_kwargs':self.add_ds_kwargs,
+                'dl_kwargs':self.dl_kwargs, 'model_kwargs':self.model_kwargs, 'stats':self.stats,
+                # Spawned processes attach to the memory of this process instead of allocating their own
+                'cache':self.cache, 'shared_arrays':self.ds.shared_arrays}
+
+    def _run_parallel(self, jobs, n_parallel):
+        "Run `jobs` (`_fit_job` arguments by key) in `n_parallel` spawned processes, each with its own device (if several GPUs are available) and share of CPU threads, and yield their results"
+        n_gpus = torch.cuda.device_count() if str(self.device).startswith('cuda') else 0
+        devices = [f'cuda:{k%n_gpus}' for k in range(n_parallel)] if n_gpus>1 else [self.device]*n_parallel
+        n_threads = max(1, (os.cpu_count() or 1)//n_parallel)
+        job_kwargs = {'el_kwargs':self._el_kwargs(), 'ensemble_dir':self.ensemble_dir, 'splits':self.splits}
+        ctx = mp.get_context('spawn')
+        results, procs, slots, keys = ctx.Queue(), {}, list(range(n_parallel)), list(jobs)
+        try:
+            while keys or procs:
+                while keys and slots:
+                    key, slot = keys.pop(0), slots.pop(0)
+                    args = (results, key, devices[slot], n_threads)
+                    procs[key] = (ctx.Process(target=_fit_job, args=args, kwargs={**job_kwargs, **jobs[key]}), slot)
+                    procs[key][0].start()
+                try: key, out, err = results.get(timeout=1)
+                except queue.Empty:
+                    for k, (p, _) in procs.items():
+                        if p.exitcode: raise RuntimeError(f'Training process of job {k} exited with code {p.exitcode}')
+                    continue
+                p, slot = procs.pop(key)
+                p.join()
+                slots.append(slot)
+                if err is not None: raise RuntimeError(f'Training job {key} failed:\n{err}')
+                yield key, out
+        finally:
+            for p, _ in procs.values(): p.terminate()
+
     def set_n(self, n):
         "Change to `n` models per ensemble"
         for i in range(n, len(self.models)):
@@ -379,11 +755,202 @@ class EnsembleLearner(EnsembleBase):
         files = files or self.files
         dls = self._get_dls(files)
         model = self._create_model()
-        learn = Learner(dls, model, metrics=self.metrics, wd=self.weight_decay, loss_func=self.loss_fn, opt_func=_optim_dict[self.optim])
+        learn = Learner(dls, model, metrics=self.metrics, wd=self.weight_decay, loss_func=self.loss_fn, opt_func=_optim_dict[self.optim], cbs=self._extra_cbs)
         if self.mixed_precision_training: learn.to_fp16()
         sug_lrs = learn.lr_find(**kwargs)
         return sug_lrs, learn.recorder
 
+    def _peak_memory(self, files, n_iter):
+        "Peak GPU memory (GB) of `n_iter` training iterations on `files`"
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(self.device)
+        learn = Learner(self._get_dls(files), self._create_model(), wd=self.weight_decay, loss_func=self.loss_fn,
+                        opt_func=_optim_dict[self.optim], cbs=self._extra_cbs+[_StopAfterCallback(n_iter)])
+        if self.mixed_precision_training: learn.to_fp16()
+        try:
+            with learn.no_bar(), learn.no_logging(): learn.fit(1)
+            return torch.cuda.max_memory_allocated(self.device)/2**30
+        except RuntimeError as e:
+            if 'out of memory' not in str(e): raise
+            return np.nan
+        finally:
+            del learn
+            torch.cuda.empty_cache()
+
+    def _throughput(self, files, n_iter):
+        "Samples/s, data wait fraction and step time (ms) of `n_iter` training iterations on `files`"
+        cb = ThroughputCallback(max_wait=0)
+        learn = Learner(self._get_dls(files), self._create_model(), wd=self.weight_decay, loss_func=self.loss_fn,
+                        opt_func=_optim_dict[self.optim], cbs=self._extra_cbs+[cb, _StopAfterCallback(n_iter)])
+        if self.mixed_precision_training: learn.to_fp16()
+        with learn.no_bar(), learn.no_logging(): learn.fit(1)
+        del learn
+        return dict(zip(cb.names, cb.summary()))
+
+    def tune_dataloader(self, files=None, num_workers=None, prefetch_factors=(2, 4), n_iter=20):
+        "Measures the training throughput for `num_workers` and `prefetch_factors` and sets the fastest in `dl_kwargs`"
+        files = files or self.files
+        if num_workers is None: num_workers = sorted({0, *[min(n, os.cpu_count()) for n in (2, 4, 8, 16)]})
+        # The prefetch factor only applies to worker processes
+        settings = list(dict.fromkeys((w, p if w>0 else None) for w in num_workers for p in prefetch_factors))
+        dl_kwargs, res = self.dl_kwargs, []
+        try:
+            for w, p in settings:
+                self.dl_kwargs = {**dl_kwargs, 'num_workers':w, 'prefetch_factor':p}
+                res.append({'num_workers':w, 'prefetch_factor':p, **self._throughput(files, n_iter)})
+        finally: self.dl_kwargs = dl_kwargs
+        df = pd.DataFrame(res)
+        best = df.loc[df['samples/s'].idxmax()]
+        self.dl_kwargs = {k:v for k,v in dl_kwargs.items() if k!='prefetch_factor'}
+        self.dl_kwargs['num_workers'] = int(best.num_workers)
+        if best.num_workers>0: self.dl_kwargs['prefetch_factor'] = int(best.prefetch_factor)
+        print(f"Using num_workers={self.dl_kwargs['num_workers']}" + (f", prefetch_factor={self.dl_kwargs['prefetch_factor']}" if best.num_workers>0 else '')
+              + f" ({best['samples/s']:.1f} samples/s)")
+        return df
+
+    def memory_report(self, files=None, n_iter=3):
+        "Peak GPU memory of training with and without gradient accumulation (`effective_batch_size`) and activation checkpointing"
+        assert str(self.device).startswith('cuda'), 'Peak memory can only be measured on CUDA devices'
+        files = files or self.files
+        bs, ebs, ac = self.batch_size, self.effective_batch_size, self.activation_checkpointing
+        full_bs = max(bs, ebs)
+        # At least one optimizer step to allocate its state
+        n_iter = max(n_iter, -(-full_bs//bs)+1)
+        settings = [('without', full_bs, 0, False), ('gradient accumulation', bs, full_bs, False),
+                    ('activation checkpointing', full_bs, 0, True), ('both', bs, full_bs, True)]
+        res = []
+        try:
+            for name, batch_size, effective_batch_size, checkpointing in settings:
+                self.config.batch_size, self.config.effective_batch_size, self.config.activation_checkpointing = batch_size, effective_batch_size, checkpointing
+                res.append({'setting':name, 'batch_size':batch_size, 'effective_batch_size':full_bs,
+                            'activation_checkpointing':checkpointing, 'peak_memory_gb':self._peak_memory(files, n_iter)})
+        finally:
+            self.config.batch_size, self.config.effective_batch_size, self.config.activation_checkpointing = bs, ebs, ac
+        return pd.DataFrame(res)
+
+# Cell
+def _init_distributed(backend='gloo'):
+    "Joins the default process group set up by `torchrun` and returns rank and world size"
+    if dist.is_initialized(): return dist.get_rank(), dist.get_world_size()
+    if int(os.environ.get('WORLD_SIZE', 1))<2:
+        warnings.warn('Distributed training requires a launch with `torchrun`, training in a single process.')
+        return 0, 1
+    dist.init_process_group(backend, init_method='env://')
+    return dist.get_rank(), dist.get_world_size()
+
+def _recorder_state(rec):
+    "Picklable training history of a fastai `Recorder`"
+    return {'lrs':list(rec.lrs), 'iters':list(rec.iters), 'losses':[float(o) for o in rec.losses],
+            'values':[list(o) for o in rec.values], 'metric_names':list(rec.metric_names)}
+
+def _load_recorder(state):
+    "`Recorder` with the training history from `_recorder_state`"
+    rec = Recorder()
+    for k,v in state.items(): setattr(rec, k, L(v) if k=='metric_names' else v)
+    return rec
+
+def _fit_job(results, key, device, n_threads, el_kwargs, ensemble_dir, splits, fold, n_epochs=None, fit_kwargs={}, config=None, find_lr=False, preproc_dir=None):
+    "Fit model `fold` of an `EnsembleLearner` (with another `config`, `preproc_dir` and `lr_find` learning rate) in a separate process and put the model path, training history and learning rate to `results`"
+    try:
+        torch.set_num_threads(n_threads)
+        cv2.setNumThreads(n_threads)
+        el_kwargs = {**el_kwargs, 'config':config or el_kwargs['config']}
+        # The cache and shared arrays of the parent belong to its preprocessing store
+        if preproc_dir is not None: el_kwargs = {**el_kwargs, 'preproc_dir':preproc_dir, 'cache':None, 'shared_arrays':None}
+        el_kwargs['config'].set_device(device)
+        el = EnsembleLearner(**el_kwargs)
+        el.ensemble_dir, el.splits = ensemble_dir, splits
+        if find_lr: fit_kwargs = {**fit_kwargs, 'base_lr':float(el.lr_find(files=splits[fold][0], show_plot=False)[0][0])}
+        el.fit(fold, n_epochs, **fit_kwargs)
+        out = {'name':el.models[fold], 'recorder':_recorder_state(el.recorder[fold]), 'base_lr':fit_kwargs.get('base_lr') or el.base_lr}
+        results.put((key, out, None))
+    except Exception: results.put((key, None, traceback.format_exc()))
+
+# Cell
+# `Config` fields that change the preprocessed data (see `BaseDataset._fingerprint`)
+_preproc_fields = ('num_classes', 'instance_labels', 'scale', 'use_pyramid', 'sampling', 'preproc_compressor',
+                   'border_weights', 'border_weight_sigma_px', 'border_weight_factor', 'foreground_background_ratio')
+
+def _best_score(rec, monitor):
+    "Best value of metric `monitor` in the training history `rec` from `_recorder_state`"
+    idx = rec['metric_names'][1:].index(monitor)
+    return max(v[idx] for v in rec['values'])
+
+class HyperparameterSearch:
+    "Successive halving search over the `Config` values in `space` with short trainings of fold `fold` of `el`"
+    def __init__(self, el:EnsembleLearner, space:dict, n_trials:int=27, min_epochs:int=1, max_epochs:int=None, eta:int=3,
+                 fold:int=1, n_parallel:int=None, monitor:str=None, seed:int=None, path:Path=None):
+        store_attr('el, space, n_trials, min_epochs, eta, fold')
+        assert all(k in asdict(el.config) for k in space), 'Search space keys must be `Config` fields'
+        self.max_epochs = max_epochs or el.n_epochs
+        self.n_parallel = n_parallel or el.n_parallel
+        self.monitor = monitor or ('dice' if el.num_classes==2 else 'dice_multi')
+        self.rng = np.random.default_rng(el.random_state if seed is None else seed)
+        self.path = Path(path) if path is not None else el.path/'search'
+        self.df, self.best_config, self._stores = None, None, set()
+
+    def sample(self):
+        "Random trial values: choices from lists, uniform from (low, high) tuples (log-uniform for `base_lr`)"
+        params = {}
+        for k, v in self.space.items():
+            if not isinstance(v, tuple): params[k] = v[self.rng.integers(len(v))]
+            elif isinstance(v[0], int): params[k] = int(self.rng.integers(v[0], v[1]+1))
+            elif k=='base_lr': params[k] = float(np.exp(self.rng.uniform(np.log(v[0]), np.log(v[1]))))
+            else: params[k] = float(self.rng.uniform(*v))
+        return params
+
+    def get_config(self, params):
+        "Copy of the learner `Config` with `params`"
+        return Config(**{**asdict(self.el.config), **params})
+
+    def _preproc_dir(self, config):
+        "Store of the learner or, if `config` changes the preprocessed data, its own store (preprocessed here, before trials read it concurrently)"
+        values = {k:getattr(config, k) for k in _preproc_fields}
+        if values=={k:getattr(self.el.config, k) for k in _preproc_fields}: return None
+        path = self.path/'.preproc'/hashlib.md5(repr(sorted(values.items())).encode()).hexdigest()[:8]
+        if path not in self._stores:
+            print(f'Preprocessing data for {values}')
+            BaseDataset(self.el.files, label_fn=self.el.label_fn, instance_labels=config.instance_labels, num_classes=config.num_classes,
+                        stats=self.el.stats, preproc_dir=path, verbose=0, **{**self.el._preproc_ds_kwargs(config), **self.el.add_ds_kwargs})
+            self._stores.add(path)
+        return path
+
+    def _job(self, params, **kwargs):
+        "`_fit_job` arguments of a trial with `params`"
+        config = self.get_config(params)
+        preproc_dir = self._preproc_dir(config)
+        # Trials with their own store cannot attach to the cache of the learner, they share its budget
+        if preproc_dir is not None: config.cache_size_gb /= self.n_parallel
+        return {'config':config, 'preproc_dir':preproc_dir, **kwargs}
+
+    def run(self):
+        "Train all trials for `min_epochs`, keep the best `1/eta` for `eta` times more epochs until `max_epochs`, and save the `Config` of the winner"
+        trials = {k:self.sample() for k in range(self.n_trials)}
+        alive, lrs, res, n_epochs = list(trials), {}, [], min(self.min_epochs, self.max_epochs)
+        while True:
+            print(f'Training {len(alive)} trials for {n_epochs} epochs')
+            # Trials without `base_lr` in the search space start from the `lr_find` suggestion
+            jobs = {k:self._job(trials[k], fold=self.fold, n_epochs=n_epochs, ensemble_dir=self.path/f'trial{k}',
+                                fit_kwargs={'base_lr':lrs[k]} if k in lrs else {}, find_lr=k not in lrs and 'base_lr' not in trials[k])
+                    for k in alive}
+            scores = {}
+            for k, out in self.el._run_parallel(jobs, min(self.n_parallel, len(jobs))):
+                lrs[k], scores[k] = out['base_lr'], _best_score(out['recorder'], self.monitor)
+                res.append({'trial':k, 'n_epochs':n_epochs, self.monitor:scores[k], **trials[k], 'base_lr':lrs[k]})
+                print(f'Trial {k}: {self.monitor} {scores[k]:.4f}')
+            if len(alive)==1 or n_epochs>=self.max_epochs: break
+            alive = sorted(alive, key=scores.get, reverse=True)[:max(1, len(alive)//self.eta)]
+            n_epochs = min(n_epochs*self.eta, self.max_epochs)
+
+        self.df = pd.DataFrame(res)
+        self.path.mkdir(exist_ok=True, parents=True)
+        self.df.to_csv(self.path/'search_results.csv', index=False)
+        best = max(scores, key=scores.get)
+        print(f'Best trial {best}: {self.monitor} {scores[best]:.4f}')
+        self.best_config = self.get_config({**trials[best], 'base_lr':lrs[best]})
+        self.best_config.save(self.path/'best_config')
+        return self.best_config
+
 # Cell
 class EnsemblePredictor(EnsembleBase):
     def __init__(self, *args, ensemble_path:Path=None, **kwargs):
@@ -460,18 +1027,15 @@ class EnsemblePredictor(EnsembleBase):
             self._create_ds(stats={}, use_zarr_data = False, verbose=1)
 
         print('Calculating metrics')
-        for i, r in progress_bar(self.df_ens.iterrows(), total=len(self.df_ens)):
-            msk = self.ds.labels[r.file][:]
-            pred = self.g_pred[r.file][:]
+        # Files are read and scored in parallel, NaN for classes absent in mask and prediction
+        cms = fast_confusion_matrices(self.df_ens.file, self.num_classes, load_fn=lambda f: (self.ds.labels[f][:], self.g_pred[f][:]))
+        dice = segmentation_scores(cms)['dice']
 
-            if self.num_classes==2:
-                self.df_ens.loc[i, f'dice_score'] = binary_dice_score(msk, pred)
-            else:
-                for cl in range(self.num_classes):
-                    msk_bin = msk==cl
-                    pred_bin = pred==cl
-                    if np.any([msk_bin, pred_bin]):
-                        self.df_ens.loc[i, f'dice_score_class{cl}'] = binary_dice_score(msk_bin, pred_bin)
+        if self.num_classes==2:
+            self.df_ens['dice_score'] = dice[:, 1]
+        else:
+            for cl in range(self.num_classes):
+                self.df_ens[f'dice_score_class{cl}'] = dice[:, cl]
 
         if self.num_classes>2:
             self.df_ens['average_dice_score'] = self.df_ens[[col for col in self.df_ens if col.startswith('dice_score_class')]].mean(axis=1)
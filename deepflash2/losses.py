@@ -1,6 +1,7 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/05_losses.ipynb (unless otherwise specified).
 
-__all__ = ['LOSSES', 'FastaiLoss', 'WeightedLoss', 'JointLoss', 'Poly1CrossEntropyLoss', 'get_loss']
+__all__ = ['LOSSES', 'FastaiLoss', 'WeightedLoss', 'JointLoss', 'Poly1CrossEntropyLoss', 'WeightedCrossEntropyLoss',
+           'get_loss']
 
 # Cell
 import torch
@@ -13,7 +14,7 @@ import segmentation_models_pytorch as smp
 from .utils import import_package
 
 # Cell
-LOSSES = ['CrossEntropyLoss', 'DiceLoss', 'SoftCrossEntropyLoss', 'CrossEntropyDiceLoss',  'JaccardLoss', 'FocalLoss', 'LovaszLoss', 'TverskyLoss', 'Poly1CrossEntropyLoss']
+LOSSES = ['CrossEntropyLoss', 'DiceLoss', 'SoftCrossEntropyLoss', 'CrossEntropyDiceLoss',  'JaccardLoss', 'FocalLoss', 'LovaszLoss', 'TverskyLoss', 'Poly1CrossEntropyLoss', 'WeightedCrossEntropyLoss']
 
 # Cell
 class FastaiLoss(_Loss):
@@ -95,6 +96,29 @@ class Poly1CrossEntropyLoss(nn.Module):
             poly1 = poly1.sum()
         return poly1
 
+# Cell
+class WeightedCrossEntropyLoss(nn.Module):
+    'Cross entropy loss with pixel-wise weights, e.g. the border weights of `RandomTileDataset(weights=True)`'
+    def __init__(self, reduction: str = "mean"):
+        super().__init__()
+        self.reduction = reduction
+
+    def forward(self, logits, labels, weights=None):
+        """
+        Forward pass
+        :param logits: tensor of shape [BNHW]
+        :param labels: tensor of shape [BHW]
+        :param weights: tensor of shape [BHW], unweighted if None (e.g., for validation tiles)
+        :return: weighted cross-entropy loss
+        """
+        loss = F.cross_entropy(input=logits, target=labels, reduction='none')
+        if weights is not None: loss = loss*weights.to(loss)
+        if self.reduction == "mean":
+            loss = loss.mean()
+        elif self.reduction == "sum":
+            loss = loss.sum()
+        return loss
+
 # Cell
 def get_loss(loss_name, mode='multiclass', classes=[1], smooth_factor=0., alpha=0.5, beta=0.5, gamma=2.0, reduction='mean', **kwargs):
     'Load losses from based on loss_name'
@@ -131,4 +155,7 @@ def get_loss(loss_name, mode='multiclass', classes=[1], smooth_factor=0., alpha=
     elif loss_name=="Poly1CrossEntropyLoss":
         loss = Poly1CrossEntropyLoss(num_classes=max(classes)+1)
 
+    elif loss_name=="WeightedCrossEntropyLoss":
+        loss = WeightedCrossEntropyLoss(reduction=reduction)
+
     return loss
\ No newline at end of file
@@ -5,7 +5,9 @@ __all__ = ['ARCHITECTURES', 'ENCODERS', 'get_pretrained_options', 'PATCH_UNET_DE
 
 # Cell
 import torch, numpy as np
+import torch.nn as nn
 import cv2
+from torch.utils.checkpoint import checkpoint
 import segmentation_models_pytorch as smp
 from fastcore.basics import patch
 from fastdownload import download_url
@@ -50,8 +52,37 @@ def forward(self:smp.decoders.unet.decoder.UnetDecoder, *features):
     return x
 
 # Cell
-def create_smp_model(arch, **kwargs):
-    'Create segmentation_models_pytorch model'
+def _checkpointed(forward, module):
+    "Wraps `forward` of `module` to recompute its activations in the backward pass instead of storing them"
+    def _forward(*args, **kwargs):
+        if not torch.is_grad_enabled(): return forward(*args, **kwargs)
+        first = [True]
+        def _run(*args, **kwargs):
+            if first[0]:
+                first[0] = False
+                return forward(*args, **kwargs)
+            # The recomputation normalizes with the batch statistics again, without a second update of the running statistics
+            bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training and m.track_running_stats]
+            for m in bns: m.track_running_stats = False
+            try: return forward(*args, **kwargs)
+            finally:
+                for m in bns: m.track_running_stats = True
+        return checkpoint(_run, *args, use_reentrant=False, **kwargs)
+    return _forward
+
+def _has_params(module): return any(True for _ in module.parameters())
+
+def _checkpoint_stages(module):
+    "Activation checkpointing for the blocks (e.g., encoder stages and decoder blocks) of `module`, containers are split into their children"
+    for m in module.children():
+        if not _has_params(m): continue
+        if isinstance(m, (nn.ModuleList, nn.ModuleDict, nn.Sequential)): _checkpoint_stages(m)
+        # Single layers (e.g., the stem convolution) store their input anyway, recomputing them saves no memory
+        elif any(_has_params(c) for c in m.children()): m.forward = _checkpointed(m.forward, m)
+
+# Cell
+def create_smp_model(arch, activation_checkpointing=False, **kwargs):
+    'Create segmentation_models_pytorch model, optionally with `activation_checkpointing` of the encoder and decoder stages for training'
 
     assert arch in ARCHITECTURES, f'Select one of {ARCHITECTURES}'
     is_convnext_encoder = kwargs['encoder_name'].startswith('tu-convnext')
@@ -77,6 +108,11 @@ def create_smp_model(arch, **kwargs):
     elif arch=="DeepLabV3Plus": model = smp.DeepLabV3Plus(**kwargs)
     else: raise NotImplementedError
 
+    if activation_checkpointing:
+        # Same parameter names, saved models load without checkpointing
+        _checkpoint_stages(getattr(model.encoder, 'model', model.encoder))
+        _checkpoint_stages(model.decoder)
+
     setattr(model, 'kwargs', kwargs)
     return model
 
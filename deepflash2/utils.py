@@ -1,14 +1,16 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/06_utils.ipynb (unless otherwise specified).
 
 __all__ = ['unzip', 'download_sample_data', 'install_package', 'import_package', 'compose_albumentations', 'clean_show',
-           'plot_results', 'multiclass_dice_score', 'binary_dice_score', 'dice_score', 'label_mask',
+           'plot_results', 'fast_confusion_matrix', 'fast_confusion_matrices', 'segmentation_scores', 'multiclass_dice_score', 'binary_dice_score', 'dice_score', 'label_mask',
            'get_instance_segmentation_metrics', 'export_roi_set', 'calc_iterations', 'get_label_fn', 'save_mask',
            'save_unc']
 
 # Cell
 import sys, subprocess, zipfile, imageio, importlib, skimage, zipfile, os, cv2
 import math, numpy as np, pandas as pd
+import torch
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 from scipy import ndimage
 from scipy.spatial.distance import jaccard
@@ -17,9 +19,10 @@ from skimage.segmentation import clear_border
 from skimage.measure import label
 from skimage.segmentation import relabel_sequential, watershed
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import maximum_bipartite_matching
 
-from sklearn.metrics import jaccard_score, multilabel_confusion_matrix
-from sklearn.metrics._classification import _prf_divide
+from sklearn.metrics import jaccard_score
 
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -32,8 +35,6 @@ from fastcore.meta import delegates
 from fastai.learner import Recorder
 from fastdownload import download_url
 
-from .models import check_cellpose_installation
-
 # Cell
 def unzip(path, zip_file):
     "Unzip and structure archive"
@@ -167,7 +168,8 @@ def plot_results(*args, df, hastarget=False, num_classes=2, model=None, instance
 @delegates(plt.subplots)
 def plot_metrics(self: Recorder, nrows=None, ncols=None, figsize=None, **kwargs):
     metrics = np.stack(self.values)
-    names = self.metric_names[1:-1]
+    # Losses and metrics precede the throughput columns of `ThroughputCallback`
+    names = [n for n in self.metric_names[1:-1] if n not in ('samples/s', 'data_wait', 'step_ms')]
     n = len(names) - 1
     if nrows is None and ncols is None:
         nrows = int(math.sqrt(n))
@@ -184,23 +186,58 @@ def plot_metrics(self: Recorder, nrows=None, ncols=None, figsize=None, **kwargs)
     plt.show()
 
 # Cell
-def multiclass_dice_score(y_true, y_pred, average='macro', **kwargs):
+def fast_confusion_matrix(y_true, y_pred, num_classes=2, sample_weight=None):
+    '''Computes the `num_classes`x`num_classes` confusion matrix (rows: `y_true`, columns: `y_pred`) of class indices in one `bincount`, numpy arrays or torch tensors (on any device), optionally with pixel weights `sample_weight`.'''
+    if torch.is_tensor(y_true) or torch.is_tensor(y_pred):
+        y_true = torch.as_tensor(y_true).flatten().long()
+        y_pred = torch.as_tensor(y_pred, device=y_true.device).flatten().long()
+        if sample_weight is not None: sample_weight = torch.as_tensor(sample_weight, device=y_true.device).flatten()
+        # Empty inputs (e.g., fully ignored tiles) give a zero matrix
+        if y_true.numel()>0 and max(y_true.max(), y_pred.max()).item()>=num_classes: raise ValueError(f'Class indices must be smaller than {num_classes}')
+        return torch.bincount(num_classes*y_true+y_pred, weights=sample_weight, minlength=num_classes**2).reshape(num_classes, num_classes)
+    y_true, y_pred = np.asarray(y_true).ravel().astype(np.intp), np.asarray(y_pred).ravel().astype(np.intp)
+    if sample_weight is not None: sample_weight = np.asarray(sample_weight).ravel()
+    if y_true.size>0 and max(y_true.max(), y_pred.max())>=num_classes: raise ValueError(f'Class indices must be smaller than {num_classes}')
+    return np.bincount(num_classes*y_true+y_pred, weights=sample_weight, minlength=num_classes**2).reshape(num_classes, num_classes)
+
+def fast_confusion_matrices(items, num_classes=2, load_fn=None, max_workers=None):
+    '''Stacks the confusion matrices of (`y_true`, `y_pred`) pairs, or of `load_fn(item)`, computed in `max_workers` threads.'''
+    def _cm(o): return fast_confusion_matrix(*(load_fn(o) if load_fn else o), num_classes=num_classes)
+    with ThreadPoolExecutor(max_workers) as ex: cms = list(ex.map(_cm, items))
+    if not cms: return np.zeros((0, num_classes, num_classes), dtype=np.intp)
+    return torch.stack(cms) if torch.is_tensor(cms[0]) else np.stack(cms)
+
+def segmentation_scores(cm):
+    '''Dice, IoU, precision and recall of all classes from confusion matrices `cm` (..., C, C), NaN for classes absent in both masks.'''
+    tp = cm.diagonal(0, -2, -1)
+    n_true, n_pred = cm.sum(-1), cm.sum(-2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {'dice': 2*tp/(n_true+n_pred), 'iou': tp/(n_true+n_pred-tp),
+                'precision': tp/n_pred, 'recall': tp/n_true}
+
+def multiclass_dice_score(y_true, y_pred, average='macro', labels=None, sample_weight=None, **kwargs):
     '''Computes the Sørensen–Dice coefficient for multiclass segmentations.'''
 
     average_options = (None, 'micro', 'macro')
     if average not in average_options:
         raise ValueError('average has to be one of ' + str(average_options))
+    if kwargs: raise TypeError(f'Unsupported arguments {list(kwargs)}, only `labels` and `sample_weight` are supported')
 
-    MCM = multilabel_confusion_matrix(y_true, y_pred, **kwargs)
+    y_true, y_pred = np.asarray(y_true), np.asarray(y_pred)
+    if labels is None: labels = np.union1d(np.unique(y_true), np.unique(y_pred))
+    labels = np.asarray(labels)
+    cm = fast_confusion_matrix(y_true, y_pred, num_classes=int(max(labels.max(), y_true.max(), y_pred.max()))+1, sample_weight=sample_weight)
 
-    numerator = 2*MCM[:, 1, 1]
-    denominator = 2*MCM[:, 1, 1] + MCM[:, 0, 1] + MCM[:, 1, 0]
+    tp = cm.diagonal()[labels]
+    numerator = 2*tp
+    denominator = cm.sum(1)[labels] + cm.sum(0)[labels]
 
     if average == 'micro':
         numerator = np.array([numerator.sum()])
         denominator = np.array([denominator.sum()])
 
-    dice_scores = _prf_divide(numerator, denominator, '', None, None, '')
+    # Zero for labels absent in both masks
+    dice_scores = np.divide(numerator, denominator, out=np.zeros(len(numerator)), where=denominator>0)
 
     if average is None:
         return dice_scores
@@ -209,16 +246,17 @@ def multiclass_dice_score(y_true, y_pred, average='macro', **kwargs):
 
 def binary_dice_score(y_true, y_pred):
     '''Compute the Sørensen–Dice coefficient for binary segmentations.'''
-    overlap = y_true*y_pred # Logical AND
-    union = y_true+y_pred # Logical OR
-    iou_score = np.divide(np.count_nonzero(overlap),np.count_nonzero(union)) #
+    y_true, y_pred = np.asarray(y_true, dtype=bool), np.asarray(y_pred, dtype=bool)
+    overlap = np.count_nonzero(y_true&y_pred) # Logical AND
+    union = np.count_nonzero(y_true|y_pred) # Logical OR
+    iou_score = np.divide(overlap, union)
     return 2*iou_score/(iou_score+1)
 
 def dice_score(y_true, y_pred, average='macro', num_classes=2, **kwargs):
     '''Computes the Sørensen–Dice coefficient.'''
 
-    y_true = np.array(y_true).flatten()
-    y_pred = np.array(y_pred).flatten()
+    y_true = np.asarray(y_true).ravel()
+    y_pred = np.asarray(y_pred).ravel()
 
     if y_true.max()>1 or y_pred.max()>1 or num_classes>2:
         labels = [i for i in range(num_classes)]
@@ -266,16 +304,39 @@ def label_mask(mask, threshold=0.5, connectivity=4, min_pixel=0, do_watershed=Fa
     return label_image
 
 # Cell
-def get_instance_segmentation_metrics(a, b, is_binary=False, thresholds=None, **kwargs):
+def _label_overlap(a, b):
+    "Sparse overlap of the instance labels `a` and `b`: overlapping label pairs, their intersections and the label areas (`bincount`)"
+    a, b = np.asarray(a).ravel().astype(np.intp), np.asarray(b).ravel().astype(np.intp)
+    area_a, area_b = np.bincount(a), np.bincount(b)
+    n = len(area_b)
+    # Only pixels where both labels are set, memory grows with the overlapping pairs instead of all label pairs
+    fg = (a>0)&(b>0)
+    pairs, inter = np.unique(a[fg]*n+b[fg], return_counts=True)
+    return pairs//n, pairs%n, inter, area_a, area_b
+
+def _n_matches(i, j, iou, threshold, matching='hungarian'):
+    "Number of one-to-one matches of the label pairs (`i`, `j`) with `iou`>=`threshold`"
+    ok = iou>=threshold
+    i, j, iou = i[ok], j[ok], iou[ok]
+    if len(np.unique(i))==len(i) and len(np.unique(j))==len(j): return len(i)
+    if matching=='greedy':
+        matched_i, matched_j = set(), set()
+        for k in np.argsort(-iou, kind='stable'):
+            if i[k] in matched_i or j[k] in matched_j: continue
+            matched_i.add(i[k]); matched_j.add(j[k])
+        return len(matched_i)
+    # Maximum number of matches (as the Hungarian algorithm on the IoU>=threshold matrix) on a sparse graph of the candidate pairs
+    _, i = np.unique(i, return_inverse=True)
+    _, j = np.unique(j, return_inverse=True)
+    candidates = csr_matrix((np.ones(len(i)), (i, j)), shape=(i.max()+1, j.max()+1))
+    return int((maximum_bipartite_matching(candidates, perm_type='column')>=0).sum())
+
+def get_instance_segmentation_metrics(a, b, is_binary=False, thresholds=None, matching='hungarian', **kwargs):
     '''
     Computes instance segmentation metric based on cellpose/stardist implementation.
     https://cellpose.readthedocs.io/en/latest/api.html#cellpose.metrics.average_precision
+    All IoU `thresholds` are evaluated on one sparse IoU matrix, instances are matched with 'hungarian' or 'greedy' `matching`.
     '''
-    try:
-        from cellpose import metrics
-    except:
-        check_cellpose_installation()
-        from cellpose import metrics
 
     # Find connected components in binary mask
     if is_binary:
@@ -285,8 +346,18 @@ def get_instance_segmentation_metrics(a, b, is_binary=False, thresholds=None, **
     if thresholds is None:
         #https://github.com/cocodataset/cocoapi/blob/master/PythonAPI/pycocotools/cocoeval.py
         thresholds = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+    thresholds = np.atleast_1d(np.asarray(thresholds, dtype=float))
+
+    i, j, inter, area_a, area_b = _label_overlap(a, b)
+    iou = inter/(area_a[i]+area_b[j]-inter)
+    n_true, n_pred = np.count_nonzero(area_a[1:]), np.count_nonzero(area_b[1:])
+
+    # Above IoU 0.5 an instance overlaps at most one other instance, all pairs are matches
+    tp = len(iou)-np.searchsorted(np.sort(iou), thresholds, side='left')
+    for k in np.flatnonzero(thresholds<=0.5): tp[k] = _n_matches(i, j, iou, thresholds[k], matching)
 
-    ap, tp, fp, fn = metrics.average_precision(a, b, threshold=thresholds)
+    fp, fn = n_pred-tp, n_true-tp
+    with np.errstate(divide='ignore', invalid='ignore'): ap = (tp/(tp+fp+fn)).astype(np.float32)
 
     return ap, tp, fp, fn
 